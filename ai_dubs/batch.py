@@ -0,0 +1,170 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Dubs a whole folder (or list) of videos in one process. The videos share
+API clients, caches, the Text-to-Speech quota and the stitching processes,
+and the batch can be stopped and restarted without redoing finished videos:
+
+    python batch.py my_videos/ outputDirectory "en" --targetLangs '["ja", "es"]'
+"""
+
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import fire
+from dubber import dub, Shared
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".mkv", ".avi", ".webm", ".m4v")
+
+
+def find_videos(source):
+    """Lists the videos to dub.
+
+    Args:
+        source (String): A directory of videos, a text file with one video path per
+            line, or a json file holding a list of video paths or of dicts like
+            {"videoFile": "a.mp4", "targetLangs": ["ja"]}, whose other keys override
+            dub() arguments for that video.
+
+    Returns:
+        list : [{"videoFile": path, ...overrides}]
+    """
+    if os.path.isdir(source):
+        return [{"videoFile": os.path.join(source, fn)} for fn in sorted(os.listdir(source))
+                if fn.lower().endswith(VIDEO_EXTENSIONS)]
+    with open(source) as f:
+        if source.endswith(".json"):
+            entries = json.load(f)
+        else:
+            entries = [line.strip() for line in f if line.strip()]
+    return [entry if isinstance(entry, dict) else {"videoFile": entry} for entry in entries]
+
+
+class BatchState:
+    """Status of every video in a batch, saved to batch.json in the output
+    directory after every change, so a crashed or stopped batch can pick up
+    where it left off. Safe to use from multiple threads.
+
+    Args:
+        path (String): json file to keep state in
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.jobs = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.jobs = json.load(f)
+
+    def get(self, jobId):
+        with self.lock:
+            return dict(self.jobs.get(jobId, {}))
+
+    def update(self, jobId, **fields):
+        with self.lock:
+            self.jobs.setdefault(jobId, {"attempts": 0}).update(fields)
+            with open(self.path + ".part", "w") as f:
+                json.dump(self.jobs, f, indent=2)
+            os.replace(self.path + ".part", self.path)
+
+
+def batch(source, outputDir, srcLang, workers=2, retryFailed=True, cacheDir=None,
+          ttsCacheMb=1024, ttsQps=10, stitchWorkers=2, **dubArgs):
+    """Dubs every video in source, several at a time.
+
+    Each video is dubbed into its own directory, outputDir/<video name>, and
+    its progress is recorded in outputDir/batch.json. Videos that already
+    finished are skipped when the batch is rerun; videos that were running
+    when it stopped resume from their last finished stage (see dub()).
+
+    Args:
+        source (String): Directory of videos, or a file listing them (see find_videos)
+        outputDir (String): Directory to write every video's output to
+        srcLang (String): Language code to translate from (i.e. "fi")
+        workers (int, optional): Videos to dub at once. Defaults to 2.
+        retryFailed (bool, optional): Retry videos that failed in an earlier run.
+            Defaults to True.
+        cacheDir (String, optional): Where to keep caches. Defaults to CACHE_DIR in .env,
+            or ~/.cache/ai_dubs.
+        ttsCacheMb (int, optional): Size limit of the synthesized audio cache in MB.
+            Defaults to 1024.
+        ttsQps (float, optional): Max text-to-speech requests per second, for the whole
+            batch. Defaults to 10.
+        stitchWorkers (int, optional): Processes stitching languages, for the whole batch.
+            Defaults to 2.
+        dubArgs: Any other arguments of dub(), i.e. --targetLangs '["ja", "es"]',
+            applied to every video
+
+    Returns:
+        dict : Number of videos per status, i.e. {"done": 9, "failed": 1}
+    """
+    os.makedirs(outputDir, exist_ok=True)
+    state = BatchState(os.path.join(outputDir, "batch.json"))
+    videos = find_videos(source)
+
+    jobs = {}
+    for video in videos:
+        jobId = os.path.splitext(os.path.basename(video["videoFile"]))[0]
+        if jobId in jobs:
+            raise ValueError(
+                f"Two videos are named {jobId}, so their outputs would collide")
+        jobs[jobId] = video
+
+    todo = []
+    for jobId in jobs:
+        status = state.get(jobId).get("status")
+        if status == "done" or (status == "failed" and not retryFailed):
+            continue
+        todo.append(jobId)
+    print(f"{len(jobs)} videos, {len(jobs) - len(todo)} already done or skipped")
+
+    shared = Shared(cacheDir=cacheDir, ttsCacheMb=ttsCacheMb, ttsQps=ttsQps,
+                    stitchWorkers=stitchWorkers)
+
+    def _run(jobId):
+        args = dict(dubArgs, srcLang=srcLang, outputDir=os.path.join(outputDir, jobId))
+        args.update(jobs[jobId])
+        state.update(jobId, status="running", videoFile=args["videoFile"],
+                     attempts=state.get(jobId).get("attempts", 0) + 1,
+                     started=time.time(), error=None)
+        print(f"Dubbing {args['videoFile']}")
+        try:
+            dub(shared=shared, **args)
+        except Exception:
+            state.update(jobId, status="failed", finished=time.time(),
+                         error=traceback.format_exc())
+            print(f"Failed to dub {args['videoFile']}, see {state.path}")
+            return
+        state.update(jobId, status="done", finished=time.time())
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(_run, todo))
+    finally:
+        shared.close()
+
+    counts = {}
+    for jobId in jobs:
+        status = state.get(jobId).get("status", "pending")
+        counts[status] = counts.get(status, 0) + 1
+    print(f"Batch finished: {counts}")
+    return counts
+
+
+if __name__ == "__main__":
+    fire.Fire(batch)
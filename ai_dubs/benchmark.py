@@ -0,0 +1,211 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Times each stage of the dubbing pipeline on synthetic videos, with the
+Google Cloud clients swapped for the local fakes in fakes.py. Results are
+saved as JSON so runs before and after a change can be compared:
+
+    python benchmark.py --out before.json
+    python benchmark.py --sizes '[[60, 10]]'    # just the quick one
+"""
+
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import ffmpeg
+import fire
+from dubber import (decode_audio, get_transcripts_json, parse_sentence_with_speaker,
+                    toSrt, translate_batch, synthesize_audio, stitch_audio)
+from metrics import Metrics
+from fakes import (CallCounter, FakeSpeechClient, FakeStorageClient, FakeTextToSpeechClient,
+                   FakeTranslateClient, synthetic_transcript)
+
+# (seconds of video, sentences spoken in it)
+DEFAULT_SIZES = [[60, 10], [600, 200], [3600, 2000]]
+
+
+def synthetic_video(path, seconds, size="320x180", fps=10):
+    """Writes a test pattern video with a stereo 44.1 kHz tone for its audio."""
+    video = ffmpeg.input(f"testsrc=size={size}:rate={fps}", f="lavfi", t=seconds)
+    audio = ffmpeg.input("sine=frequency=220:sample_rate=44100", f="lavfi", t=seconds)
+    ffmpeg.output(video, audio, path, vcodec="libx264", preset="ultrafast",
+                  acodec="aac", ac=2).global_args(
+        "-loglevel", "error").overwrite_output().run()
+    return path
+
+
+class PeakRss:
+    """Measures the peak resident memory of this process while in a with
+    block, by sampling it every few milliseconds. ffmpeg and other child
+    processes aren't included; see _child_peak_mb."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.pageSize = os.sysconf("SC_PAGE_SIZE")
+
+    def _rss(self):
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * self.pageSize
+
+    def _sample(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, self._rss())
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self._rss()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, self._rss())
+
+
+def _child_peak_mb():
+    # Largest peak RSS of any child process (i.e. ffmpeg) so far
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+
+def _measure(results, name, counter, fn, *args, **kwargs):
+    """Runs fn, and records its wall time, peak memory and API calls in results."""
+    before = counter.snapshot()
+    with PeakRss() as rss:
+        start = time.perf_counter()
+        value = fn(*args, **kwargs)
+        secs = time.perf_counter() - start
+    after = counter.snapshot()
+    results[name] = {
+        "secs": round(secs, 4),
+        "peakRssMb": round(rss.peak / 1024 ** 2, 1),
+        "childPeakRssMb": round(_child_peak_mb(), 1),
+        "apiCalls": {key: after[key] - before.get(key, 0)
+                     for key in after if after[key] != before.get(key, 0)},
+    }
+    print(f"  {name}: {secs:.2f}s, peak {results[name]['peakRssMb']} MB")
+    return value
+
+
+def benchmark_size(workDir, seconds, sentences, targetLang="es", speakerCount=2,
+                   ttsLatency=0, ttsWorkers=8):
+    """Runs every stage once on a synthetic video of the given size.
+
+    Returns:
+        dict : {stage: {"secs", "peakRssMb", "childPeakRssMb", "apiCalls"}}
+    """
+    counter = CallCounter()
+    results = {}
+    videoFile = synthetic_video(os.path.join(workDir, "video.mp4"), seconds)
+
+    audioPath = _measure(results, "decode_audio", counter, decode_audio,
+                         videoFile, os.path.join(workDir, "audio.wav"))
+
+    # Like dub(), upload the audio for the Speech API to read, then delete it
+    blob = FakeStorageClient(counter=counter).bucket("fake").blob("tmp/audio.wav")
+    _measure(results, "upload", counter, blob.upload_from_filename,
+             audioPath, content_type="audio/wav")
+    speechClient = FakeSpeechClient(synthetic_transcript(
+        seconds, sentences, speakerCount=speakerCount), counter=counter)
+    transcripts = _measure(results, "get_transcripts_json", counter, get_transcripts_json,
+                           "gs://fake/tmp/audio.wav", "en", speakerCount=speakerCount,
+                           client=speechClient)
+    blob.delete()
+    sentenceList = _measure(results, "parse_sentence_with_speaker", counter,
+                            parse_sentence_with_speaker, transcripts, "en")
+    _measure(results, "toSrt", counter, toSrt, transcripts)
+
+    translations = _measure(results, "translate_batch", counter, translate_batch,
+                            [sentence["en"] for sentence in sentenceList], targetLang, "en",
+                            client=FakeTranslateClient(counter=counter))
+    for sentence, translation in zip(sentenceList, translations):
+        sentence[targetLang] = translation
+
+    # synthesize_audio calls speakUnderDuration once per sentence
+    audioDir = os.path.join(workDir, "audioClips")
+    ttsClient = FakeTextToSpeechClient(latency=ttsLatency, counter=counter)
+    _measure(results, "speakUnderDuration", counter, synthesize_audio,
+             sentenceList, [targetLang], audioDir, client=ttsClient,
+             workers=ttsWorkers, qps=None)
+
+    stitchMetrics = Metrics()
+    _measure(results, "stitch_audio", counter, stitch_audio, sentenceList,
+             os.path.join(audioDir, targetLang), videoFile,
+             os.path.join(workDir, f"{targetLang}.mp4"), metrics=stitchMetrics,
+             lang=targetLang)
+    results["stitch_audio"]["steps"] = {
+        name: round(stats["secs"], 4) for name, stats in stitchMetrics.to_dict()["stages"].items()}
+    return results
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(sizes=DEFAULT_SIZES, out="benchmark_results.json", ttsLatency=0,
+              ttsWorkers=8, workDir=None):
+    """Benchmarks the pipeline at each size and saves the results.
+
+    Args:
+        sizes (list, optional): [seconds, sentences] pairs to run.
+            Defaults to 1 min/10, 10 min/200 and 1 h/2000 sentences.
+        out (String, optional): JSON file to write results to. Defaults to
+            "benchmark_results.json".
+        ttsLatency (float, optional): Simulated seconds per Text-to-Speech request.
+            Defaults to 0, which measures only our own overhead.
+        ttsWorkers (int, optional): Concurrent Text-to-Speech requests. Defaults to 8.
+        workDir (String, optional): Where to write synthetic media. Defaults to a
+            temporary directory, deleted afterwards.
+    """
+    report = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "ttsLatency": ttsLatency,
+        "runs": [],
+    }
+    for seconds, sentences in sizes:
+        print(f"{seconds}s video, {sentences} sentences")
+        runDir = tempfile.mkdtemp(dir=workDir)
+        try:
+            stages = benchmark_size(runDir, seconds, sentences,
+                                    ttsLatency=ttsLatency, ttsWorkers=ttsWorkers)
+        finally:
+            shutil.rmtree(runDir)
+        report["runs"].append(
+            {"seconds": seconds, "sentences": sentences, "stages": stages})
+
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {out}")
+
+
+if __name__ == "__main__":
+    fire.Fire(benchmark)
@@ -0,0 +1,219 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def default_cache_dir():
+    """Where caches shared between videos live. Set CACHE_DIR in .env to override."""
+    return os.environ.get("CACHE_DIR") or os.path.join(
+        os.path.expanduser("~"), ".cache", "ai_dubs")
+
+
+def hash_key(*parts):
+    """Builds a cache key from any json-serializable values.
+
+    Args:
+        parts: Values that, taken together, uniquely identify a cached result
+
+    Returns:
+        String : sha256 hex digest
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    """A content-addressed cache of bytes stored as files on disk.
+
+    Each value lives in its own file named after its key. A small index.json
+    keeps the size and last access time of every entry, so that when the cache
+    grows past maxBytes the least recently used entries are deleted. The index
+    is rebuilt from the files on disk if it's missing or stale, so a crash
+    never loses cached data. Safe to use from multiple threads.
+
+    Args:
+        cacheDir (String): Directory to keep cached files in
+        maxBytes (int, optional): Size limit of the cache. Defaults to 1 GB.
+    """
+
+    INDEX_FILE = "index.json"
+    # How many writes to make before saving the index to disk
+    SAVE_EVERY = 100
+
+    def __init__(self, cacheDir, maxBytes=1024 ** 3):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.unsaved = 0
+        os.makedirs(os.path.join(cacheDir, "objects"), exist_ok=True)
+        self.index = self._load_index()
+        self.size = sum(entry["size"] for entry in self.index.values())
+
+    def _path(self, key):
+        return os.path.join(self.cacheDir, "objects", key[:2], key)
+
+    def _load_index(self):
+        index = {}
+        try:
+            with open(os.path.join(self.cacheDir, self.INDEX_FILE)) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+        # Reconcile the index with what's actually on disk
+        onDisk = {}
+        objectsDir = os.path.join(self.cacheDir, "objects")
+        for prefix in os.listdir(objectsDir):
+            for key in os.listdir(os.path.join(objectsDir, prefix)):
+                if key.endswith(".part"):
+                    continue
+                stat = os.stat(os.path.join(objectsDir, prefix, key))
+                onDisk[key] = index.get(
+                    key, {"size": stat.st_size, "atime": stat.st_mtime})
+        return onDisk
+
+    def _save_index(self):
+        fn = os.path.join(self.cacheDir, self.INDEX_FILE)
+        with open(fn + ".part", "w") as f:
+            json.dump(self.index, f)
+        os.replace(fn + ".part", fn)
+        self.unsaved = 0
+
+    def _evict(self):
+        # Delete least recently used entries until we're under the size limit
+        for key in sorted(self.index, key=lambda k: self.index[k]["atime"]):
+            if self.size <= self.maxBytes:
+                break
+            self.size -= self.index.pop(key)["size"]
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def get(self, key):
+        """Returns the bytes stored under key, or None if they aren't cached."""
+        with self.lock:
+            if key not in self.index:
+                self.misses += 1
+                return None
+            try:
+                with open(self._path(key), "rb") as f:
+                    data = f.read()
+            except OSError:
+                self.size -= self.index.pop(key)["size"]
+                self.misses += 1
+                return None
+            self.index[key]["atime"] = time.time()
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        """Stores data (bytes) under key, evicting old entries if needed."""
+        fn = self._path(key)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        # Write under a unique name first so readers never see a partial file
+        tmpFn = f"{fn}.{threading.get_ident()}.part"
+        with open(tmpFn, "wb") as f:
+            f.write(data)
+        os.replace(tmpFn, fn)
+        with self.lock:
+            if key in self.index:
+                self.size -= self.index[key]["size"]
+            self.index[key] = {"size": len(data), "atime": time.time()}
+            self.size += len(data)
+            self._evict()
+            self.unsaved += 1
+            if self.unsaved >= self.SAVE_EVERY:
+                self._save_index()
+
+    def flush(self):
+        """Writes the index to disk."""
+        with self.lock:
+            self._save_index()
+
+    def stats(self):
+        """Returns hit/miss counters and the current size of the cache."""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / total if total else 0,
+            "entries": len(self.index),
+            "bytes": self.size,
+        }
+
+
+class TranslationMemory:
+    """Remembers translations of past sentences in a sqlite database, so text
+    that shows up in many videos (intros, outros, catchphrases) is only ever
+    sent to the Translation API once. Safe to use from multiple threads.
+
+    Args:
+        path (String): sqlite database file, i.e. ~/.cache/ai_dubs/translations.sqlite
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS translations (
+            source TEXT, sourceLang TEXT, targetLang TEXT, translation TEXT,
+            PRIMARY KEY (source, sourceLang, targetLang))""")
+        self.db.commit()
+
+    def get_many(self, texts, sourceLang, targetLang):
+        """Looks up translations for texts.
+
+        Returns:
+            dict : {text: translation} for every text that's been translated before
+        """
+        texts = set(texts)
+        found = {}
+        with self.lock:
+            for text in texts:
+                row = self.db.execute(
+                    "SELECT translation FROM translations WHERE source=? AND sourceLang=? AND targetLang=?",
+                    (text, sourceLang or "", targetLang)).fetchone()
+                if row:
+                    found[text] = row[0]
+            self.hits += len(found)
+            self.misses += len(texts) - len(found)
+        return found
+
+    def put_many(self, translations, sourceLang, targetLang):
+        """Saves translations, a dict of {text: translation}."""
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?)",
+                [(text, sourceLang or "", targetLang, translation)
+                 for text, translation in translations.items()])
+            self.db.commit()
+
+    def stats(self):
+        """Returns hit/miss counters."""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / total if total else 0,
+        }
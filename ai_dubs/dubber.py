@@ -17,38 +17,214 @@ from google.cloud import speech_v1p1beta1 as speech
 from google.cloud import texttospeech
 from google.cloud import translate_v2 as translate
 from google.cloud import storage
-from moviepy.editor import VideoFileClip, AudioFileClip, CompositeVideoClip
-from moviepy.video.tools.subtitles import SubtitlesClip, TextClip
+from google.api_core import exceptions
+from moviepy.editor import VideoFileClip, AudioFileClip
 import os
 import shutil
 import ffmpeg
 import time
 import json
+import math
+import bisect
+import collections
 import sys
 import tempfile
 import uuid
+import wave
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
 from dotenv import load_dotenv
 import fire
 import html
+import numpy as np
+from cache import DiskCache, TranslationMemory, default_cache_dir, hash_key
+from mixing import mix_blocks, open_wav, segment_to_array
+from manifest import Manifest
+from transcript import WordTable
+from metrics import Metrics, payload_size, profiled
 
 # Load config in .env file
 load_dotenv()
 
+# Errors from Google Cloud APIs that are worth trying again
+RETRYABLE_ERRORS = (
+    exceptions.ResourceExhausted,
+    exceptions.ServiceUnavailable,
+    exceptions.DeadlineExceeded,
+    exceptions.InternalServerError,
+)
 
-def decode_audio(inFile, outFile):
-    """Converts a video file to a wav file.
+
+class TokenBucket:
+    """Thread-safe token bucket used to stay under an API's request quota.
 
     Args:
-        inFile (String): i.e. my/great/movie.mp4
-        outFile (String): i.e. my/great/movie.wav
+        rate (float): Tokens added per second, i.e. the sustained requests/sec
+        capacity (int, optional): Largest burst allowed. Defaults to rate.
     """
-    if not outFile[-4:] != "wav":
-        outFile += ".wav"
-    AudioSegment.from_file(inFile).set_channels(
-        1).export(outFile, format="wav")
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available, then takes it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def with_retries(fn, retries=3, backoff=1, retryOn=RETRYABLE_ERRORS, onRetry=None):
+    """Calls fn(), retrying with exponential backoff and jitter on failure.
+
+    Args:
+        fn (function): Function taking no arguments
+        retries (int, optional): How many times to retry before giving up. Defaults to 3.
+        backoff (float, optional): Seconds to wait before the first retry. Doubles after
+            every attempt. Defaults to 1.
+        retryOn (tuple, optional): Exception types worth retrying. Defaults to RETRYABLE_ERRORS.
+        onRetry (function, optional): Called with the exception before each retry. Defaults to None.
+
+    Returns:
+        The return value of fn
+    """
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except retryOn as error:
+            if attempt == retries:
+                raise
+            if onRetry:
+                onRetry(error)
+            time.sleep(backoff * 2 ** attempt * (1 + random.random()))
+
+
+class ThrottledClient:
+    """Wraps a Google Cloud client so that every API call waits for a
+    rate limiter token and is retried on transient errors. Attributes that
+    aren't methods are passed through untouched. Every attempt is recorded in
+    metrics, under the name of the client's class and the method.
+
+    Args:
+        client: Client to wrap, i.e. texttospeech.TextToSpeechClient()
+        bucket (TokenBucket, optional): Rate limiter shared by all callers. Defaults to None.
+        retries (int, optional): How many times to retry a failed call. Defaults to 3.
+        metrics (Metrics, optional): Where to record calls. Defaults to None.
+    """
+
+    def __init__(self, client, bucket=None, retries=3, metrics=None):
+        self.client = client
+        self.bucket = bucket
+        self.retries = retries
+        self.metrics = metrics if metrics else Metrics()
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        callName = f"{type(self.client).__name__}.{name}"
+
+        def _call(*args, **kwargs):
+            bytesOut = payload_size(args) + payload_size(kwargs)
+
+            def _once():
+                if self.bucket:
+                    self.bucket.acquire()
+                with self.metrics.call(callName, bytesOut=bytesOut) as record:
+                    result = attr(*args, **kwargs)
+                    record.bytesIn = payload_size(result)
+                return result
+            return with_retries(_once, retries=self.retries,
+                                onRetry=lambda error: self.metrics.retry(callName))
+        return _call
 
 
-def get_transcripts_json(gcsPath, langCode, phraseHints=[], speakerCount=1, enhancedModel=None):
+def decode_audio(inFile, outFile, sampleRate=16000, channels=1, chunkSize=1024 * 1024):
+    """Converts a video file to a 16-bit wav or flac file, by default mono and
+    at the sample rate the Speech API works best with. ffmpeg's output is
+    streamed to disk in chunks, so memory use stays flat however long the
+    video is.
+
+    Args:
+        inFile (String): i.e. my/great/movie.mp4
+        outFile (String): i.e. my/great/movie.wav, or my/great/movie.flac for a
+            smaller (lossless) file to upload
+        sampleRate (int, optional): Sample rate in Hz, or None to keep the video's.
+            Defaults to 16000.
+        channels (int, optional): Number of channels, or None to keep the video's.
+            Defaults to 1.
+        chunkSize (int, optional): Bytes to read from ffmpeg at a time. Defaults to 1 MB.
+
+    Returns:
+        String : Path of the file written
+    """
+    ext = os.path.splitext(outFile)[1].lower()
+    if ext not in (".wav", ".flac"):
+        outFile += ".wav"
+        ext = ".wav"
+
+    if not sampleRate or not channels:
+        try:
+            source = next(stream for stream in ffmpeg.probe(inFile)["streams"]
+                          if stream["codec_type"] == "audio")
+        except (ffmpeg.Error, StopIteration):
+            raise Exception(f"ffmpeg couldn't find any audio in {inFile}")
+        sampleRate = sampleRate if sampleRate else int(source["sample_rate"])
+        channels = channels if channels else int(source["channels"])
+
+    audio = ffmpeg.input(inFile).audio
+    if ext == ".flac":
+        stream = audio.output("pipe:", format="flac", ac=channels, ar=sampleRate)
+    else:
+        # Ask for raw samples and write the wav header ourselves, since ffmpeg
+        # can't go back and fill in the header's length fields on a pipe
+        stream = audio.output("pipe:", format="s16le",
+                              acodec="pcm_s16le", ac=channels, ar=sampleRate)
+    process = stream.global_args(
+        "-loglevel", "error").run_async(pipe_stdout=True)
+
+    # Write under a temporary name, so a failed run never leaves behind a
+    # truncated file that a rerun would mistake for finished output
+    partFile = outFile + ".part"
+    if ext == ".flac":
+        out = open(partFile, "wb")
+        write = out.write
+    else:
+        out = wave.open(partFile, "wb")
+        out.setnchannels(channels)
+        out.setsampwidth(2)
+        out.setframerate(sampleRate)
+        write = out.writeframesraw
+
+    with out:
+        while True:
+            chunk = process.stdout.read(chunkSize)
+            if not chunk:
+                break
+            write(chunk)
+    if process.wait():
+        os.remove(partFile)
+        raise Exception(f"ffmpeg couldn't extract audio from {inFile}")
+    os.replace(partFile, outFile)
+    return outFile
+
+
+def get_transcripts_json(gcsPath, langCode, phraseHints=[], speakerCount=1, enhancedModel=None,
+                         client=None):
     """Transcribes audio files.
 
     Args:
@@ -57,6 +233,7 @@ def get_transcripts_json(gcsPath, langCode, phraseHints=[], speakerCount=1, enha
         phraseHints (String[]): list of words that are unusual but likely to appear in the audio file.
         speakerCount (int, optional): Number of speakers in the audio. Only works on English. Defaults to None.
         enhancedModel (String, optional): Option to use an enhanced speech model, i.e. "video"
+        client (SpeechClient, optional): Client to reuse. Defaults to a new client.
 
     Returns:
         list | Operation.error
@@ -80,7 +257,8 @@ def get_transcripts_json(gcsPath, langCode, phraseHints=[], speakerCount=1, enha
             json.append(data)
         return json
 
-    client = speech.SpeechClient()  
+    if not client:
+        client = speech.SpeechClient()
     audio = speech.RecognitionAudio(uri=gcsPath)
 
     diarize = speakerCount if speakerCount > 1 else False
@@ -111,63 +289,244 @@ def get_transcripts_json(gcsPath, langCode, phraseHints=[], speakerCount=1, enha
 
     return _jsonify(res)
 
+def _read_pcm(inFile, sampleRate=16000, chunkSize=1024 * 1024):
+    """Decodes inFile with ffmpeg, yielding mono int16 samples a chunk at a time."""
+    process = ffmpeg.input(inFile).audio.output(
+        "pipe:", format="s16le", acodec="pcm_s16le", ac=1, ar=sampleRate).global_args(
+        "-loglevel", "error").run_async(pipe_stdout=True)
+    leftover = b""
+    while True:
+        chunk = process.stdout.read(chunkSize)
+        if not chunk:
+            break
+        # A read can end halfway through a sample, so carry the odd byte over
+        chunk = leftover + chunk
+        usable = len(chunk) - len(chunk) % 2
+        leftover = chunk[usable:]
+        yield np.frombuffer(chunk[:usable], dtype=np.int16)
+    if process.wait():
+        raise Exception(f"ffmpeg couldn't decode {inFile}")
+
+
+def find_silences(audioFile, minSilenceSecs=0.5, silenceThresh=-40, frameSecs=0.01,
+                  sampleRate=16000):
+    """Finds the quiet stretches of an audio file.
+
+    Args:
+        audioFile (String): i.e. the output of decode_audio
+        minSilenceSecs (float, optional): Shortest pause that counts as silence. Defaults to 0.5.
+        silenceThresh (float, optional): Loudness in dBFS below which audio is silent.
+            Defaults to -40.
+        frameSecs (float, optional): Resolution of the analysis. Defaults to 0.01.
+        sampleRate (int, optional): Rate to analyze the audio at. Defaults to 16000.
+
+    Returns:
+        (list, float) : (start, end) seconds of each silence, and the length of the audio
+    """
+    frameLen = int(sampleRate * frameSecs)
+    levels = []
+    rest = np.zeros(0, dtype=np.int16)
+    for samples in _read_pcm(audioFile, sampleRate=sampleRate):
+        samples = np.concatenate((rest, samples))
+        n = len(samples) // frameLen * frameLen
+        frames = samples[:n].reshape(-1, frameLen).astype(np.float32)
+        levels.append(np.sqrt(np.mean(frames ** 2, axis=1)))
+        rest = samples[n:]
+    rms = np.concatenate(levels) if levels else np.zeros(0)
+
+    silent = 20 * np.log10(np.maximum(rms, 1) / 32768) < silenceThresh
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], silent.astype(np.int8), [0]))))
+    starts, ends = edges[::2], edges[1::2]
+    longEnough = (ends - starts) * frameSecs >= minSilenceSecs
+    silences = [(float(start * frameSecs), float(end * frameSecs))
+                for start, end in zip(starts[longEnough], ends[longEnough])]
+    return silences, len(rms) * frameSecs
+
+
+def plan_chunks(silences, totalSecs, maxChunkSecs=300):
+    """Picks where to cut audio into chunks no longer than maxChunkSecs. Cuts
+    go in the middle of the last silence before the limit, so words aren't
+    split between chunks, unless there's no silence in the second half of
+    the chunk, in which case it's cut at the limit.
+
+    Args:
+        silences (list): (start, end) seconds of each silence, from find_silences
+        totalSecs (float): Length of the audio
+        maxChunkSecs (float, optional): Longest chunk allowed. Defaults to 300.
+
+    Returns:
+        list : (start, end) seconds of each chunk
+    """
+    cuts = [(start + end) / 2 for start, end in silences]
+    chunks = []
+    start = 0
+    while totalSecs - start > maxChunkSecs:
+        limit = start + maxChunkSecs
+        i = bisect.bisect_right(cuts, limit) - 1
+        cut = cuts[i] if i >= 0 and cuts[i] > start + maxChunkSecs / 2 else limit
+        chunks.append((start, cut))
+        start = cut
+    chunks.append((start, totalSecs))
+    return chunks
+
+
+def _match_speakers(prevWords, words, maxGapSecs=0.3):
+    # Speaker tags are assigned independently in each chunk, so "speaker 1"
+    # in one chunk might be "speaker 2" in the next. Chunks overlap, so the
+    # words in the overlap were tagged in both: vote on which of the previous
+    # chunk's (already global) tags each of this chunk's tags corresponds to.
+    prevStarts = [word['start_time'] for word in prevWords]
+    votes = collections.Counter()
+    for word in words:
+        i = bisect.bisect_left(prevStarts, word['start_time'])
+        nearby = [j for j in (i - 1, i) if 0 <= j < len(prevWords) and
+                  abs(prevStarts[j] - word['start_time']) <= maxGapSecs]
+        if nearby:
+            j = min(nearby, key=lambda j: abs(prevStarts[j] - word['start_time']))
+            votes[(word['speaker_tag'], prevWords[j]['speaker_tag'])] += 1
+
+    mapping = {}
+    for (tag, globalTag), _ in votes.most_common():
+        if tag not in mapping and globalTag not in mapping.values():
+            mapping[tag] = globalTag
+    # Tags we couldn't match keep their number if it's free
+    tags = sorted(set(word['speaker_tag'] for word in words))
+    for tag in tags:
+        if tag not in mapping:
+            taken = set(mapping.values())
+            mapping[tag] = tag if tag not in taken else max(taken | set(tags)) + 1
+    return mapping
+
+
+def merge_chunk_transcripts(transcripts, chunks):
+    """Merges transcripts of overlapping chunks into a single transcript in
+    the format returned by get_transcripts_json.
+
+    Args:
+        transcripts (list): get_transcripts_json output for each chunk, with times
+            relative to the start of the chunk
+        chunks (list): (start, end) seconds of each chunk. Chunk audio may run past
+            end, overlapping the next chunk.
+
+    Returns:
+        list : [{"transcript": "lalala", "words": [{"word": "la", "start_time": 20, ...}]}]
+    """
+    merged = []
+    prevTail = []
+    for (start, end), transcript in zip(chunks, transcripts):
+        # Shift every word onto the timeline of the whole video
+        sections = []
+        for section in transcript:
+            words = [dict(word, start_time=word['start_time'] + start,
+                          end_time=word['end_time'] + start) for word in section['words']]
+            sections.append((section['transcript'], words))
+
+        allWords = [word for _, words in sections for word in words]
+        mapping = _match_speakers(prevTail, allWords)
+
+        for text, words in sections:
+            kept = [dict(word, speaker_tag=mapping[word['speaker_tag']]) for word in words
+                    if start <= word['start_time'] < end]
+            if not kept:
+                continue
+            if len(kept) < len(words):
+                text = " ".join(word['word'] for word in kept)
+            merged.append({"transcript": text, "words": kept})
+
+        prevTail = sorted((dict(word, speaker_tag=mapping[word['speaker_tag']])
+                           for word in allWords if word['start_time'] >= end),
+                          key=lambda word: word['start_time'])
+    return merged
+
+
+def transcribe_chunked(audioFile, bucket, langCode, phraseHints=[], speakerCount=1,
+                       maxChunkSecs=300, overlapSecs=5, workers=8, client=None, metrics=None):
+    """Transcribes long audio by cutting it into chunks at pauses, transcribing
+    the chunks concurrently, and stitching the results back together.
+
+    Chunks overlap by overlapSecs so that speaker tags, which the Speech API
+    assigns separately for each chunk, can be matched up across chunks.
+
+    Args:
+        audioFile (String): Local audio file, i.e. the output of decode_audio
+        bucket (storage.Bucket): Bucket to upload chunks to while they're transcribed
+        langCode (String): language code, i.e. "en"
+        phraseHints (String[], optional): Words likely to appear in the audio. Defaults to [].
+        speakerCount (int, optional): Number of speakers in the audio. Defaults to 1.
+        maxChunkSecs (float, optional): Longest chunk, not counting overlap. Defaults to 300.
+        overlapSecs (float, optional): How far each chunk runs into the next. Defaults to 5.
+        workers (int, optional): Chunks to transcribe at once. Defaults to 8.
+        client (SpeechClient, optional): Client shared by all workers. Defaults to a new client.
+        metrics (Metrics, optional): Where to record API calls. Defaults to None.
+
+    Returns:
+        list : Transcript in the same format as get_transcripts_json
+    """
+    silences, totalSecs = find_silences(audioFile)
+    chunks = plan_chunks(silences, totalSecs, maxChunkSecs=maxChunkSecs)
+    print(f"Transcribing {len(chunks)} chunks")
+    metrics = metrics if metrics else Metrics()
+    client = ThrottledClient(client if client else speech.SpeechClient(), metrics=metrics)
+    ext = os.path.splitext(audioFile)[1]
+    tmpDir = tempfile.mkdtemp()
+
+    def _transcribe(i):
+        start, end = chunks[i]
+        fn = os.path.join(tmpDir, f"{i}{ext}")
+        ffmpeg.input(audioFile, ss=start, t=end - start + overlapSecs).output(
+            fn).global_args("-loglevel", "error").overwrite_output().run()
+        blob = bucket.blob(os.path.join("tmp", str(uuid.uuid4()) + ext))
+        with metrics.call("storage.upload", bytesOut=os.path.getsize(fn)):
+            blob.upload_from_filename(fn, content_type=f"audio/{ext[1:]}")
+        try:
+            return get_transcripts_json(
+                f"gs://{bucket.name}/{blob.name}", langCode, phraseHints=phraseHints,
+                speakerCount=speakerCount, client=client)
+        finally:
+            with metrics.call("storage.delete"):
+                blob.delete()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            transcripts = list(pool.map(_transcribe, range(len(chunks))))
+    finally:
+        shutil.rmtree(tmpDir)
+    return merge_chunk_transcripts(transcripts, chunks)
+
+
 def parse_sentence_with_speaker(json, lang):
     """Takes json from get_transcripts_json and breaks it into sentences
-    spoken by a single person. Sentences deliniated by a >= 1 second pause/
+    spoken by a single person. Sentences deliniated by any pause between words.
 
     Args:
-        json (string[]): [{"transcript": "lalala", "words": [{"word": "la", "start_time": 20, "end_time": 21, "speaker_tag: 2}]}]
+        json (string[] | WordTable): [{"transcript": "lalala", "words": [{"word": "la", "start_time": 20, "end_time": 21, "speaker_tag: 2}]}]
         lang (string): language code, i.e. "en"
     Returns:
         string[]: [{"sentence": "lalala", "speaker": 1, "start_time": 20, "end_time": 21}]
     """
+    table = json if isinstance(json, WordTable) else WordTable.from_json(json)
+    if not len(table):
+        return []
 
     # Special case for parsing japanese words
-    def get_word(word, lang):
-        if lang == "ja":
-            return word.split('|')[0]
-        return word
-
-    sentences = []
-    sentence = {}
-    for result in json:
-        for i, word in enumerate(result['words']):
-            wordText = get_word(word['word'], lang)
-            if not sentence:
-                sentence = {
-                    lang: [wordText],
-                    'speaker': word['speaker_tag'],
-                    'start_time': word['start_time'],
-                    'end_time': word['end_time']
-                }
-            # If we have a new speaker, save the sentence and create a new one:
-            elif word['speaker_tag'] != sentence['speaker']:
-                sentence[lang] = ' '.join(sentence[lang])
-                sentences.append(sentence)
-                sentence = {
-                    lang: [wordText],
-                    'speaker': word['speaker_tag'],
-                    'start_time': word['start_time'],
-                    'end_time': word['end_time']
-                }
-            else:
-                sentence[lang].append(wordText)
-                sentence['end_time'] = word['end_time']
-
-            # If there's greater than one second gap, assume this is a new sentence
-            if i+1 < len(result['words']) and word['end_time'] < result['words'][i+1]['start_time']:
-                sentence[lang] = ' '.join(sentence[lang])
-                sentences.append(sentence)
-                sentence = {}
-        if sentence:
-            sentence[lang] = ' '.join(sentence[lang])
-            sentences.append(sentence)
-            sentence = {}
-
-    return sentences
-
-
-def translate_text(input, targetLang, sourceLang=None):
+    vocab = table.vocab
+    if lang == "ja":
+        vocab = np.array([word.split('|')[0] for word in vocab], dtype=object)
+    words = table.words(vocab).tolist()
+
+    starts = table.sentence_starts()
+    ends = np.append(starts[1:], len(table))
+    return [{
+        lang: ' '.join(words[first:last]),
+        'speaker': speaker,
+        'start_time': startTime,
+        'end_time': endTime
+    } for first, last, speaker, startTime, endTime in zip(
+        starts.tolist(), ends.tolist(), table.speaker[starts].tolist(),
+        table.start[starts].tolist(), table.end[ends - 1].tolist())]
+
+
+def translate_text(input, targetLang, sourceLang=None, client=None):
     """Translates from sourceLang to targetLang. If sourceLang is empty,
     it will be auto-detected.
 
@@ -175,19 +534,69 @@ def translate_text(input, targetLang, sourceLang=None):
         sentence (String): Sentence to translate
         targetLang (String): i.e. "en"
         sourceLang (String, optional): i.e. "es" Defaults to None.
+        client (translate.Client, optional): Client to reuse. Defaults to a new client.
 
     Returns:
         String: translated text
     """
 
-    translate_client = translate.Client()
+    translate_client = client if client else translate.Client()
     result = translate_client.translate(
         input, target_language=targetLang, source_language=sourceLang)
 
     return html.unescape(result['translatedText'])
 
 
-def speak(text, languageCode, voiceName=None, speakingRate=1):
+def translate_batch(texts, targetLang, sourceLang=None, client=None, memory=None,
+                    maxChars=5000, maxSegments=128):
+    """Translates many texts at once, packing them into as few requests as the
+    Translation API's size limits allow. Texts already in the translation
+    memory, and duplicates, aren't sent at all.
+
+    Args:
+        texts (String[]): Texts to translate
+        targetLang (String): i.e. "en"
+        sourceLang (String, optional): i.e. "es". Defaults to None (auto-detect).
+        client (translate.Client, optional): Client to reuse. Defaults to a new client.
+        memory (TranslationMemory, optional): Translations from earlier runs. Defaults to None.
+        maxChars (int, optional): Max characters per request. Defaults to 5000.
+        maxSegments (int, optional): Max texts per request. Defaults to 128.
+
+    Returns:
+        String[]: translated texts, in the same order as texts
+    """
+    translations = memory.get_many(
+        texts, sourceLang, targetLang) if memory else {}
+    todo = list(dict.fromkeys(
+        text for text in texts if text not in translations))
+
+    # Split what's left into chunks that fit in one request each
+    chunks = []
+    chunk, chunkChars = [], 0
+    for text in todo:
+        if chunk and (len(chunk) == maxSegments or chunkChars + len(text) > maxChars):
+            chunks.append(chunk)
+            chunk, chunkChars = [], 0
+        chunk.append(text)
+        chunkChars += len(text)
+    if chunk:
+        chunks.append(chunk)
+
+    if chunks and not client:
+        client = translate.Client()
+    for chunk in chunks:
+        results = client.translate(
+            chunk, target_language=targetLang, source_language=sourceLang)
+        translated = {text: html.unescape(result['translatedText'])
+                      for text, result in zip(chunk, results)}
+        translations.update(translated)
+        if memory:
+            memory.put_many(translated, sourceLang, targetLang)
+
+    return [translations[text] for text in texts]
+
+
+def speak(text, languageCode, voiceName=None, speakingRate=1, client=None, cache=None):
     """Converts text to audio
 
     Args:
@@ -195,12 +604,23 @@ def speak(text, languageCode, voiceName=None, speakingRate=1):
         languageCode (String): Language (i.e. "en")
         voiceName: (String, optional): See https://cloud.google.com/text-to-speech/docs/voices
         speakingRate: (int, optional): speed up or slow down speaking
+        client (TextToSpeechClient, optional): Client to reuse. Defaults to a new client.
+        cache (DiskCache, optional): Cache of previously synthesized audio. Defaults to None.
     Returns:
         bytes : Audio in wav format
     """
 
+    # Identical requests always produce the same audio, so check the cache first
+    if cache:
+        key = hash_key(text, languageCode, voiceName,
+                       float(speakingRate), "MP3")
+        audio = cache.get(key)
+        if audio:
+            return audio
+
     # Instantiates a client
-    client = texttospeech.TextToSpeechClient()
+    if not client:
+        client = texttospeech.TextToSpeechClient()
 
     # Set the text input to be synthesized
     synthesis_input = texttospeech.SynthesisInput(text=text)
@@ -230,10 +650,142 @@ def speak(text, languageCode, voiceName=None, speakingRate=1):
         audio_config=audio_config
     )
 
+    if cache:
+        cache.put(key, response.audio_content)
     return response.audio_content
 
 
-def speakUnderDuration(text, languageCode, durationSecs, voiceName=None):
+# Bitrates in kbps, indexed by [MPEG-1?][layer][bitrate index]
+_MP3_BITRATES = {
+    True: {
+        1: [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+        2: [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+        3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    },
+    False: {
+        1: [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+        2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+        3: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    },
+}
+# Sample rates in Hz, indexed by the header's version bits then sample rate index
+_MP3_SAMPLE_RATES = {
+    3: [44100, 48000, 32000],  # MPEG-1
+    2: [22050, 24000, 16000],  # MPEG-2
+    0: [11025, 12000, 8000],   # MPEG-2.5
+}
+
+
+def mp3_duration(audio):
+    """Computes the duration of mp3 audio by walking its frame headers, without
+    decoding it. Xing/Info frames, which hold metadata rather than sound, and
+    ID3 tags are skipped.
+
+    Args:
+        audio (bytes): mp3 data, i.e. the output of speak()
+
+    Returns:
+        float : duration in seconds
+    """
+    pos = 0
+    # Skip an ID3v2 tag, whose size is stored as a 28-bit "syncsafe" integer
+    if audio[:3] == b"ID3" and len(audio) >= 10:
+        pos = 10 + (audio[6] << 21 | audio[7] << 14 | audio[8] << 7 | audio[9])
+
+    duration = 0
+    firstFrame = True
+    while pos + 4 <= len(audio):
+        header = int.from_bytes(audio[pos:pos + 4], "big")
+        version = (header >> 19) & 3
+        layer = 4 - ((header >> 17) & 3)
+        bitrateIdx = (header >> 12) & 15
+        rateIdx = (header >> 10) & 3
+        # Not a valid frame header, so resync one byte at a time
+        if (header >> 21) != 0x7FF or version == 1 or layer == 4 \
+                or bitrateIdx in (0, 15) or rateIdx == 3:
+            pos += 1
+            continue
+
+        mpeg1 = version == 3
+        bitrate = _MP3_BITRATES[mpeg1][layer][bitrateIdx] * 1000
+        sampleRate = _MP3_SAMPLE_RATES[version][rateIdx]
+        padding = (header >> 9) & 1
+        if layer == 1:
+            samples = 384
+            frameLength = (12 * bitrate // sampleRate + padding) * 4
+        else:
+            samples = 1152 if mpeg1 or layer == 2 else 576
+            frameLength = samples // 8 * bitrate // sampleRate + padding
+
+        isInfoFrame = firstFrame and (
+            b"Xing" in audio[pos:pos + frameLength] or b"Info" in audio[pos:pos + frameLength])
+        if not isInfoFrame:
+            duration += samples / sampleRate
+        firstFrame = False
+        pos += frameLength
+
+    return duration
+
+
+class SpeakingRateModel:
+    """Learns how many characters per second each voice speaks at speakingRate=1,
+    so speakUnderDuration can pick a speaking rate before calling the API
+    instead of synthesizing a sentence, measuring it, and synthesizing it again.
+
+    Estimates are saved to a json file so later runs start with what earlier
+    runs learned. Safe to use from multiple threads.
+
+    Args:
+        path (String, optional): json file to load and save estimates. Defaults to None.
+        minSamples (int, optional): Observations needed before a voice's estimate
+            is trusted. Defaults to 5.
+    """
+
+    def __init__(self, path=None, minSamples=5):
+        self.path = path
+        self.minSamples = minSamples
+        self.lock = threading.Lock()
+        # {voice: {"chars": total chars, "secs": total secs at rate 1, "samples": count}}
+        self.voices = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.voices = json.load(f)
+
+    @staticmethod
+    def _voice(languageCode, voiceName):
+        return voiceName if voiceName else languageCode
+
+    def observe(self, text, languageCode, voiceName, speakingRate, durationSecs):
+        """Records that text took durationSecs to say at speakingRate."""
+        if not durationSecs:
+            return
+        with self.lock:
+            stats = self.voices.setdefault(self._voice(languageCode, voiceName),
+                                           {"chars": 0, "secs": 0, "samples": 0})
+            stats["chars"] += len(text)
+            stats["secs"] += durationSecs * speakingRate
+            stats["samples"] += 1
+
+    def predict(self, text, languageCode, voiceName):
+        """Returns the expected duration of text at speakingRate=1 in seconds,
+        or None if we haven't seen enough of this voice yet."""
+        with self.lock:
+            stats = self.voices.get(self._voice(languageCode, voiceName))
+            if not stats or stats["samples"] < self.minSamples:
+                return None
+            return len(text) * stats["secs"] / stats["chars"]
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            with open(self.path + ".part", "w") as f:
+                json.dump(self.voices, f)
+            os.replace(self.path + ".part", self.path)
+
+
+def speakUnderDuration(text, languageCode, durationSecs, voiceName=None, client=None,
+                       cache=None, rateModel=None):
     """Speak text within a certain time limit.
     If audio already fits within duratinSecs, no changes will be made.
 
@@ -242,30 +794,128 @@ def speakUnderDuration(text, languageCode, durationSecs, voiceName=None):
         languageCode (String): language code, i.e. "en"
         durationSecs (int): Time limit in seconds
         voiceName (String, optional): See https://cloud.google.com/text-to-speech/docs/voices
+        client (TextToSpeechClient, optional): Client to reuse. Defaults to a new client.
+        cache (DiskCache, optional): Cache of previously synthesized audio. Defaults to None.
+        rateModel (SpeakingRateModel, optional): Used to guess the right speaking rate up
+            front, so most sentences only need one request. Defaults to None.
 
     Returns:
         bytes : Audio in wav format
     """
-    baseAudio = speak(text, languageCode, voiceName=voiceName)
-    assert len(baseAudio)
-    f = tempfile.NamedTemporaryFile(mode="w+b")
-    f.write(baseAudio)
-    f.flush()
-    baseDuration = AudioSegment.from_mp3(f.name).duration_seconds
-    f.close()
-    ratio = baseDuration / durationSecs
+    speakingRate = 1
+    predicted = rateModel.predict(
+        text, languageCode, voiceName) if rateModel else None
+    # If we expect the sentence to be too long, go straight to a faster rate,
+    # with a little extra speed to be safe
+    if predicted and predicted > durationSecs:
+        speakingRate = min(4, math.ceil(predicted / durationSecs * 10.5) / 10)
+
+    audio = speak(text, languageCode, voiceName=voiceName, speakingRate=speakingRate,
+                  client=client, cache=cache)
+    assert len(audio)
+    duration = mp3_duration(audio)
+    if rateModel:
+        rateModel.observe(text, languageCode, voiceName,
+                          speakingRate, duration)
+    ratio = duration / durationSecs
 
     # if the audio fits, return it
-    if ratio <= 1:
-        return baseAudio
+    if ratio <= 1 or speakingRate >= 4:
+        return audio
 
-    # If the base audio is too long to fit in the segment...
+    # If the audio is too long to fit in the segment...
 
     # round to one decimal point and go a little faster to be safe,
-    ratio = round(ratio, 1)
+    ratio = round(ratio * speakingRate, 1)
     if ratio > 4:
         ratio = 4
-    return speak(text, languageCode, voiceName=voiceName, speakingRate=ratio)
+    return speak(text, languageCode, voiceName=voiceName, speakingRate=ratio,
+                 client=client, cache=cache)
+
+
+def synthesize_audio(sentences, langs, audioDir, voices={}, client=None,
+                     workers=8, qps=10, retries=3, cache=None, rateModel=None, only=None,
+                     onLanguageDone=None, metrics=None, bucket=None):
+    """Synthesizes every sentence in every language concurrently.
+
+    Each (sentence, language) pair is an independent job run on a thread pool.
+    Requests are throttled by a token bucket so we stay under the TTS quota,
+    and failed requests are retried with backoff. Cache hits skip the API, and
+    so the rate limiter, entirely. Clip i of language lang is always written to
+    audioDir/lang/i.mp3, whatever order jobs finish in. Jobs are queued one
+    language after another, so the first languages finish (and can be stitched
+    with onLanguageDone) while later ones are still being synthesized.
+
+    Args:
+        sentences (list): Output of parse_sentence_with_speaker, with translations
+        langs (list): Languages to synthesize, i.e. ["ja", "es"]
+        audioDir (String): Directory to write clips to, in a directory per language.
+        voices (dict, optional): Which voices to use, i.e. {"en": "en-AU-Standard-A"}. Defaults to {}.
+        client (TextToSpeechClient, optional): Client shared by all workers. Defaults to a new client.
+        workers (int, optional): Number of concurrent requests. Defaults to 8.
+        qps (float, optional): Max requests per second, or None for no limit. Defaults to 10.
+        retries (int, optional): How many times to retry a failed request. Defaults to 3.
+        cache (DiskCache, optional): Cache of previously synthesized audio. Defaults to None.
+        rateModel (SpeakingRateModel, optional): Learned speaking rates, shared by all
+            workers. Defaults to a new, empty model.
+        only (set, optional): (lang, sentence index) pairs to synthesize. Other clips are
+            left as they are. Defaults to None (synthesize everything).
+        onLanguageDone (function, optional): Called with a language, from a worker
+            thread, as soon as all of its clips are written. Defaults to None.
+        metrics (Metrics, optional): Where to record API calls. Defaults to None.
+        bucket (TokenBucket, optional): Rate limiter shared with other callers, used
+            instead of qps. Defaults to None.
+
+    Returns:
+        dict : Clip paths for each language, in sentence order, i.e. {"ja": ["out/ja/0.mp3", ...]}
+    """
+    if not client:
+        client = texttospeech.TextToSpeechClient()
+    if not bucket and qps:
+        bucket = TokenBucket(qps)
+    client = ThrottledClient(client, bucket=bucket, retries=retries, metrics=metrics)
+    if not rateModel:
+        rateModel = SpeakingRateModel()
+
+    def _synthesize(lang, i, sentence):
+        audio = speakUnderDuration(
+            sentence[lang], lang, sentence['end_time'] - sentence['start_time'],
+            voiceName=voices.get(lang), client=client, cache=cache, rateModel=rateModel)
+        fn = os.path.join(audioDir, lang, f"{i}.mp3")
+        # Write to a temporary name first so a crash never leaves a partial clip
+        with open(fn + ".part", 'wb') as f:
+            f.write(audio)
+        os.replace(fn + ".part", fn)
+        with lock:
+            remaining[lang] -= 1
+            finished = not remaining[lang]
+        if finished and onLanguageDone:
+            onLanguageDone(lang)
+        return fn
+
+    for lang in langs:
+        os.makedirs(os.path.join(audioDir, lang), exist_ok=True)
+
+    jobs = [(lang, i, sentence) for lang in langs for i, sentence in enumerate(sentences)
+            if only is None or (lang, i) in only]
+    # Clips left to write in each language
+    remaining = collections.Counter(lang for lang, _, _ in jobs)
+    lock = threading.Lock()
+    if onLanguageDone:
+        for lang in langs:
+            if not remaining[lang]:
+                onLanguageDone(lang)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_synthesize, *job) for job in jobs]
+            for future in futures:
+                future.result()
+    finally:
+        if cache:
+            cache.flush()
+    return {lang: [os.path.join(audioDir, lang, f"{i}.mp3") for i in range(len(sentences))]
+            for lang in langs}
 
 
 def toSrt(transcripts, charsPerLine=60):
@@ -273,7 +923,7 @@ def toSrt(transcripts, charsPerLine=60):
     with English.
 
     Args:
-        transcripts ({}): Transcripts returned from Speech API
+        transcripts ({} | WordTable): Transcripts returned from Speech API
         charsPerLine (int): max number of chars to write per line
 
     Returns:
@@ -304,32 +954,192 @@ def toSrt(transcripts, charsPerLine=60):
         hours, minutes = divmod(minutes, 60)
         return "%d:%d:%d,%d" % (hours, minutes, seconds, millisecs)
 
-    def _toSrt(words, startTime, endTime, index):
-        return f"{index}\n" + _srtTime(startTime) + " --> " + _srtTime(endTime) + f"\n{words}"
+    table = transcripts if isinstance(
+        transcripts, WordTable) else WordTable.from_json(transcripts)
+    if not len(table):
+        return ""
+    words = table.words().tolist()
+    starts = table.line_starts(charsPerLine)
+    ends = np.append(starts[1:], len(table))
 
-    startTime = None
-    sentence = ""
     srt = []
-    index = 1
-    for word in [word for x in transcripts for word in x['words']]:
-        if not startTime:
-            startTime = word['start_time']
+    for index, (first, last, startTime, endTime) in enumerate(zip(
+            starts.tolist(), ends.tolist(), table.start[starts].tolist(),
+            table.end[ends - 1].tolist())):
+        line = " " + " ".join(words[first:last])
+        srt.append(f"{index + 1}\n" + _srtTime(startTime) +
+                   " --> " + _srtTime(endTime) + f"\n{line}")
+
+    return '\n\n'.join(srt)
 
-        sentence += " " + word['word']
 
-        if len(sentence) > charsPerLine:
-            srt.append(_toSrt(sentence, startTime, word['end_time'], index))
-            index += 1
-            sentence = ""
-            startTime = None
+def mix_audio(sentences, audioDir, movieFile, outFile, overlayGain=-30, metrics=None,
+              soundtrack=None):
+    """Overlays audio clips on the movie's original soundtrack and writes the
+    result as AAC audio, ready to be muxed into a video without re-encoding.
 
-    if len(sentence):
-        srt.append(_toSrt(sentence, startTime, word['end_time'], index))
+    The soundtrack is memory-mapped rather than loaded, and mixed a block at
+    a time straight into the encoder, so several languages can be mixed at
+    once from one decoded copy of it without each holding it in memory.
 
-    return '\n\n'.join(srt)
+    Args:
+        sentences (list): Output of parse_sentence_with_speaker
+        audioDir (String): Directory containing generated audio files to stitch together
+        movieFile (String): Path to movie file to dub.
+        outFile (String): Where to write the dubbed audio, i.e. "es.m4a"
+        overlayGain (int, optional): How quiet to make source audio when overlaying dubs.
+            Defaults to -30.
+        metrics (Metrics, optional): Where to record how long each step took. Defaults to None.
+        soundtrack (String, optional): movieFile's audio already decoded to a wav by
+            decode_audio(movieFile, fn, sampleRate=None, channels=None). Defaults to None
+            (decode it now).
+
+    Returns:
+       void : Writes audio file to outFile path
+    """
+    metrics = metrics if metrics else Metrics()
+
+    # Files in the audioDir should be labeled 0.wav, 1.wav, etc.
+    audioFiles = [x for x in os.listdir(audioDir) if x.endswith(".mp3")]
+    audioFiles.sort(key=lambda x: int(x.split('.')[0]))
+
+    tmpDir = tempfile.mkdtemp()
+    try:
+        with metrics.stage("loadAudio"):
+            # Grab the original audio
+            if not soundtrack:
+                soundtrack = decode_audio(movieFile, os.path.join(tmpDir, "soundtrack.wav"),
+                                          sampleRate=None, channels=None)
+            original, frameRate = open_wav(soundtrack)
+            channels = original.shape[1]
+            # Grab the computer-generated audio files, in the soundtrack's format
+            clips = [segment_to_array(AudioSegment.from_mp3(os.path.join(audioDir, x))
+                                      .set_frame_rate(frameRate).set_channels(channels)
+                                      .set_sample_width(2)) for x in audioFiles]
+
+        # Place each computer-generated audio at the correct timestamp,
+        # encoding the mix as it's made
+        placed = list(zip(sentences, clips))
+        positions = [int(sentence['start_time'] * 1000 * frameRate / 1000.0)
+                     for sentence, _ in placed]
+        with metrics.stage("mixAndExport"):
+            process = ffmpeg.input("pipe:", format="s16le", ar=frameRate, ac=channels).output(
+                outFile, format="ipod", acodec="aac").global_args(
+                "-loglevel", "error").overwrite_output().run_async(pipe_stdin=True)
+            try:
+                for block in mix_blocks(original, [clip for _, clip in placed], positions,
+                                        overlayGain=overlayGain):
+                    process.stdin.write(block.tobytes())
+                process.stdin.close()
+            except BaseException:
+                process.kill()
+                raise
+            if process.wait():
+                raise Exception(f"ffmpeg couldn't encode {outFile}")
+    finally:
+        shutil.rmtree(tmpDir)
+
+
+# How burned in subtitles look, in ASS style syntax (see libass)
+SUBTITLE_STYLE = "FontName=Georgia,FontSize=22,Outline=1,Shadow=0,MarginV=20"
+
+# mp4 files only understand three letter (ISO 639-2) language codes, so
+# translate the two letter ones used everywhere else. mkv takes either.
+_ISO639_2 = {
+    "af": "afr", "ar": "ara", "bg": "bul", "bn": "ben", "ca": "cat", "cs": "cze",
+    "cy": "wel", "da": "dan", "de": "ger", "el": "gre", "en": "eng", "es": "spa",
+    "et": "est", "eu": "baq", "fa": "per", "fi": "fin", "fr": "fre", "gl": "glg",
+    "gu": "guj", "he": "heb", "hi": "hin", "hu": "hun", "id": "ind", "is": "ice",
+    "it": "ita", "ja": "jpn", "kn": "kan", "ko": "kor", "lt": "lit", "lv": "lav",
+    "ml": "mal", "mr": "mar", "ms": "may", "nb": "nob", "nl": "dut", "no": "nor",
+    "pa": "pan", "pl": "pol", "pt": "por", "ro": "rum", "ru": "rus", "sk": "slo",
+    "sr": "srp", "sv": "swe", "ta": "tam", "te": "tel", "th": "tha", "tr": "tur",
+    "uk": "ukr", "ur": "urd", "vi": "vie", "zh": "chi",
+}
+
+
+def _language_tag(lang):
+    # i.e. "en-US" -> "eng"
+    lang = lang.split('-')[0].lower()
+    return _ISO639_2.get(lang, lang)
+
+
+def mux_video(movieFile, outFile, audioTracks, keepOriginalAudio=False, originalLang=None,
+              subtitleTracks=[]):
+    """Writes a video with new audio tracks. The video stream is copied from
+    movieFile as is and the audio is copied from audioTracks, so nothing is
+    re-encoded. Subtitles are added as soft subtitle tracks, which players
+    can turn on and off.
+
+    Args:
+        movieFile (String): Path to the source movie
+        outFile (String): Where to write the movie, i.e. "dubbed.mkv"
+        audioTracks (list): Audio to include, as (path, languageCode) tuples, i.e.
+            [("es.m4a", "es"), ("ja.m4a", "ja")]. The first track is the default.
+        keepOriginalAudio (bool, optional): Also include the source movie's audio
+            as the last track. Defaults to False.
+        originalLang (String, optional): Language of the source movie's audio. Defaults to None.
+        subtitleTracks (list, optional): SRT files to include, as (path, languageCode) tuples.
+            Defaults to [].
+
+    Returns:
+       void : Writes movie file to outFile path
+    """
+    movie = ffmpeg.input(movieFile)
+    streams = [movie.video] + [ffmpeg.input(path).audio for path, _ in audioTracks]
+    tracks = [(lang, f"Dubbed ({lang})" if lang else "Dubbed") for _, lang in audioTracks]
+    if keepOriginalAudio:
+        streams.append(movie.audio)
+        tracks.append((originalLang, "Original"))
+    streams += [ffmpeg.input(path)["s"] for path, _ in subtitleTracks]
+
+    # Tag every audio track so players can show a language menu. Each
+    # option can only be passed once, so address the title by its output
+    # stream index (the video is stream 0) and the language by audio index.
+    metadata = {}
+    for i, (lang, title) in enumerate(tracks):
+        if lang:
+            metadata[f"metadata:s:a:{i}"] = f"language={_language_tag(lang)}"
+        metadata[f"metadata:s:{i + 1}"] = f"title={title}"
+        metadata[f"disposition:a:{i}"] = "default" if i == 0 else "0"
+    for i, (_, lang) in enumerate(subtitleTracks):
+        if lang:
+            metadata[f"metadata:s:s:{i}"] = f"language={_language_tag(lang)}"
+        metadata[f"metadata:s:{len(tracks) + i + 1}"] = \
+            f"title=Subtitles ({lang})" if lang else "title=Subtitles"
+
+    # mp4 only holds subtitles as mov_text, so those have to be converted
+    # (which is instant); everything else is copied
+    subtitleCodec = "mov_text" if outFile.lower().endswith((".mp4", ".m4v", ".mov")) else "srt"
+    ffmpeg.output(*streams, outFile, **{"c:v": "copy", "c:a": "copy", "c:s": subtitleCodec},
+                  **metadata).overwrite_output().run(quiet=True)
+
+
+def burn_subtitles(movieFile, audioFile, srtPath, outFile, style=SUBTITLE_STYLE):
+    """Writes a video with subtitles drawn onto every frame, using ffmpeg's
+    subtitles filter, and audioFile as its audio. The video is re-encoded
+    once, in a single ffmpeg pass; the audio is copied.
+
+    Args:
+        movieFile (String): Path to the source movie
+        audioFile (String): Audio to use, i.e. the output of mix_audio
+        srtPath (String): Subtitles to burn in, i.e. from toSrt
+        outFile (String): Where to write the movie
+        style (String, optional): How the subtitles look, as ASS style overrides.
+            Defaults to SUBTITLE_STYLE.
+
+    Returns:
+       void : Writes movie file to outFile path
+    """
+    video = ffmpeg.input(movieFile).video.filter("subtitles", srtPath, force_style=style)
+    audio = ffmpeg.input(audioFile).audio
+    ffmpeg.output(video, audio, outFile, vcodec="libx264", acodec="copy").overwrite_output().run(
+        quiet=True)
 
 
-def stitch_audio(sentences, audioDir, movieFile, outFile, srtPath=None, overlayGain=-30):
+def stitch_audio(sentences, audioDir, movieFile, outFile, srtPath=None, overlayGain=-30,
+                 streamCopy=True, metrics=None, softSubtitles=False, srtLang=None,
+                 soundtrack=None, lang=None):
     """Combines sentences, audio clips, and video file into the ultimate dubbed video
 
     Args:
@@ -340,52 +1150,153 @@ def stitch_audio(sentences, audioDir, movieFile, outFile, srtPath=None, overlayG
         srtPath (String, optional): Path to transcript/srt file, if desired.
         overlayGain (int, optional): How quiet to make source audio when overlaying dubs. 
             Defaults to -30.
+        streamCopy (bool, optional): Copy the video stream instead of re-encoding it
+            with moviepy. Burning in subtitles always re-encodes (with ffmpeg). Defaults to True.
+        metrics (Metrics, optional): Where to record how long each step took. Defaults to None.
+        softSubtitles (bool, optional): Add the subtitles as a track players can turn on
+            and off, instead of burning them into the video. Nothing is re-encoded.
+            Defaults to False.
+        srtLang (String, optional): Language of the subtitles. Defaults to None.
+        soundtrack (String, optional): movieFile's audio, already decoded (see mix_audio).
+            Defaults to None.
+        lang (String, optional): Language of the dubbed audio, i.e. "es", so players can
+            label the track when it's muxed in. Defaults to None.
 
     Returns:
        void : Writes movie file to outFile path
     """
+    metrics = metrics if metrics else Metrics()
 
-    # Files in the audioDir should be labeled 0.wav, 1.wav, etc.
-    audioFiles = os.listdir(audioDir)
-    audioFiles.sort(key=lambda x: int(x.split('.')[0]))
-
-    # Grab the computer-generated audio file
-    segments = [AudioSegment.from_mp3(
-        os.path.join(audioDir, x)) for x in audioFiles]
-    # Also, grab the original audio
-    dubbed = AudioSegment.from_file(movieFile)
-
-    # Place each computer-generated audio at the correct timestamp
-    for sentence, segment in zip(sentences, segments):
-        dubbed = dubbed.overlay(
-            segment, position=sentence['start_time'] * 1000, gain_during_overlay=overlayGain)
     # Write the final audio to a temporary output file
-    audioFile = tempfile.NamedTemporaryFile()
-    dubbed.export(audioFile)
-    audioFile.flush()
-
-    # Add the new audio to the video and save it
-    clip = VideoFileClip(movieFile)
-    audio = AudioFileClip(audioFile.name)
-    clip = clip.set_audio(audio)
-
-    # Add transcripts, if supplied
-    if srtPath:
-        width, height = clip.size[0] * 0.75, clip.size[1] * 0.20
-        def generator(txt): return TextClip(txt, font='Georgia-Regular',
-                                            size=[width, height], color='black', method="caption")
-        subtitles = SubtitlesClip(
-            srtPath, generator).set_pos(("center", "bottom"))
-        clip = CompositeVideoClip([clip, subtitles])
-
-    clip.write_videofile(outFile, codec='libx264', audio_codec='aac')
+    audioFile = tempfile.NamedTemporaryFile(suffix=".m4a")
+    mix_audio(sentences, audioDir, movieFile,
+              audioFile.name, overlayGain=overlayGain, metrics=metrics, soundtrack=soundtrack)
+
+    if srtPath and not softSubtitles:
+        # Draw the subtitles on while encoding, all inside ffmpeg
+        with metrics.stage("encodeVideo"):
+            burn_subtitles(movieFile, audioFile.name, srtPath, outFile)
+    elif streamCopy or srtPath:
+        # Only the audio changed, so just swap it in
+        with metrics.stage("muxVideo"):
+            mux_video(movieFile, outFile, [(audioFile.name, lang)],
+                      subtitleTracks=[(srtPath, srtLang)] if srtPath else [])
+    else:
+        # Add the new audio to the video and save it
+        clip = VideoFileClip(movieFile)
+        audio = AudioFileClip(audioFile.name)
+        clip = clip.set_audio(audio)
+        with metrics.stage("encodeVideo"):
+            clip.write_videofile(outFile, codec='libx264', audio_codec='aac')
     audioFile.close()
 
+
+def _stitch_worker(fn, args, kwargs, profiler=None, profilePath=None):
+    """Runs stitch_audio or mix_audio in a worker process, timing its steps
+    and optionally profiling it.
+
+    Returns:
+        dict : The job's Metrics.to_dict()
+    """
+    metrics = Metrics()
+    with profiled(profiler, profilePath), metrics.stage("total"):
+        fn(*args, metrics=metrics, **kwargs)
+    return metrics.to_dict()
+
+
+class Shared:
+    """Clients, caches and worker pools that many dubs can share, so a batch
+    of videos (see batch.py) pays for them once, and the Text-to-Speech quota
+    and stitching CPUs are divided between all of them. Everything is made
+    the first time it's used. Safe to use from multiple threads.
+
+    Args:
+        cacheDir (String, optional): Where to keep caches. Defaults to default_cache_dir().
+        ttsCacheMb (int, optional): Size limit of the synthesized audio cache in MB.
+            Defaults to 1024.
+        ttsQps (float, optional): Max text-to-speech requests per second, across every
+            dub. Defaults to 10.
+        stitchWorkers (int, optional): Processes to stitch languages in, across every
+            dub. Defaults to 2.
+    """
+
+    def __init__(self, cacheDir=None, ttsCacheMb=1024, ttsQps=10, stitchWorkers=2):
+        self.cacheDir = cacheDir if cacheDir else default_cache_dir()
+        self.ttsCacheMb = ttsCacheMb
+        self.ttsQps = ttsQps
+        self.stitchWorkers = stitchWorkers
+        self.lock = threading.Lock()
+        self.made = {}
+
+    def _get(self, name, make):
+        with self.lock:
+            if name not in self.made:
+                self.made[name] = make()
+            return self.made[name]
+
+    @property
+    def speechClient(self):
+        return self._get("speechClient", speech.SpeechClient)
+
+    @property
+    def ttsClient(self):
+        return self._get("ttsClient", texttospeech.TextToSpeechClient)
+
+    @property
+    def translateClient(self):
+        return self._get("translateClient", translate.Client)
+
+    @property
+    def storageClient(self):
+        return self._get("storageClient", storage.Client)
+
+    @property
+    def ttsBucket(self):
+        return self._get("ttsBucket", lambda: TokenBucket(self.ttsQps) if self.ttsQps else None)
+
+    @property
+    def ttsCache(self):
+        return self._get("ttsCache", lambda: DiskCache(
+            os.path.join(self.cacheDir, "tts"), maxBytes=self.ttsCacheMb * 1024 ** 2))
+
+    @property
+    def memory(self):
+        return self._get("memory", lambda: TranslationMemory(
+            os.path.join(self.cacheDir, "translations.sqlite")))
+
+    @property
+    def rateModel(self):
+        return self._get("rateModel", lambda: SpeakingRateModel(
+            os.path.join(self.cacheDir, "speaking_rates.json")))
+
+    @property
+    def stitchPool(self):
+        # Worker processes are spawned rather than forked, because forking
+        # while the TTS threads hold gRPC connections can deadlock
+        return self._get("stitchPool", lambda: ProcessPoolExecutor(
+            max_workers=self.stitchWorkers, mp_context=multiprocessing.get_context("spawn")))
+
+    def close(self):
+        """Saves the caches and waits for the stitch workers to finish."""
+        with self.lock:
+            made = dict(self.made)
+        if "rateModel" in made:
+            made["rateModel"].save()
+        if "ttsCache" in made:
+            made["ttsCache"].flush()
+        if "stitchPool" in made:
+            made["stitchPool"].shutdown()
+
+
 def dub(
         videoFile, outputDir, srcLang, targetLangs=[],
         storageBucket=None, phraseHints=[], dubSrc=False,
         speakerCount=1, voices={}, srt=False,
-        newDir=False, genAudio=False, noTranslate=False):
+        newDir=False, genAudio=False, noTranslate=False, audioFormat="wav",
+        chunkSecs=None, transcribeWorkers=8,
+        ttsWorkers=8, ttsQps=10, stitchWorkers=2, cacheDir=None, ttsCacheMb=1024,
+        streamCopy=True, multiTrack=None, profileStitch=None, shared=None,
+        softSubtitles=False):
     """Translate and dub a movie.
 
     Args:
@@ -400,123 +1311,313 @@ def dub(
         voices (dict, optional): Which voices to use for dubbing, i.e. {"en": "en-AU-Standard-A"}. Defaults to {}.
         srt (bool, optional): Path of SRT transcript file, if it exists. Defaults to False.
         newDir (bool, optional): Whether to start dubbing from scratch or use files in outputDir. Defaults to False.
+            Even without it, only the steps whose inputs changed since the last run are redone.
         genAudio (bool, optional): Generate new audio, even if it's already been generated. Defaults to False.
         noTranslate (bool, optional): Don't translate. Defaults to False.
+        audioFormat (String, optional): Format of the audio extracted for transcription, "wav"
+            or "flac". flac files are about half the size to upload. Defaults to "wav".
+        chunkSecs (int, optional): Split audio at pauses into chunks of at most this many seconds
+            and transcribe them in parallel. Defaults to None (transcribe in one request).
+        transcribeWorkers (int, optional): Chunks to transcribe at once. Defaults to 8.
+        ttsWorkers (int, optional): Number of concurrent text-to-speech requests. Defaults to 8.
+        ttsQps (float, optional): Max text-to-speech requests per second. Defaults to 10.
+        stitchWorkers (int, optional): Number of languages to mix and encode at once, each in
+            its own process. Defaults to 2.
+        cacheDir (String, optional): Where to keep caches shared between videos. Defaults to
+            CACHE_DIR in .env, or ~/.cache/ai_dubs.
+        ttsCacheMb (int, optional): Size limit of the synthesized audio cache in MB. Defaults to 1024.
+        streamCopy (bool, optional): Copy the source video stream into dubbed videos instead of
+            re-encoding it. Defaults to True.
+        multiTrack (String, optional): Container format, "mkv" or "mp4", to write one video holding
+            every dubbed language as a separate audio track, instead of one video per language.
+            Defaults to None.
+        profileStitch (String, optional): Profile stitching each language with "cprofile" or
+            "pyinstrument", writing the profiles to outputDir/profiles. Defaults to None.
+        shared (Shared, optional): Clients, caches and stitch workers to use, i.e. ones shared
+            by a batch of videos. cacheDir, ttsCacheMb, ttsQps and stitchWorkers are ignored
+            when it's given. Defaults to None (make new ones for this video).
+        softSubtitles (bool, optional): With srt, add the subtitles to dubbed videos as a track
+            players can turn on and off, instead of burning them in. Defaults to False.
 
     Raises:
         void : Writes dubbed video and intermediate files to outputDir
     """
 
     baseName = os.path.split(videoFile)[-1].split('.')[0]
-    if newDir:
-        shutil.rmtree(outputDir)
-
-    if not os.path.exists(outputDir):
-        os.mkdir(outputDir)
-
-    outputFiles = os.listdir(outputDir)
-
-    if not f"{baseName}.wav" in outputFiles:
-        print("Extracting audio from video")
-        fn = os.path.join(outputDir, baseName + ".wav")
-        decode_audio(videoFile, fn)
-        print(f"Wrote {fn}")
-
-    if not f"transcript.json" in outputFiles:
-        storageBucket = storageBucket if storageBucket else os.environ['STORAGE_BUCKET']
-        if not storageBucket:
-            raise Exception(
-                "Specify variable STORAGE_BUCKET in .env or as an arg")
-
-        print("Transcribing audio")
-        print("Uploading to the cloud...")
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(storageBucket)
-
-        tmpFile = os.path.join("tmp", str(uuid.uuid4()) + ".wav")
-        blob = bucket.blob(tmpFile)
-        # Temporary upload audio file to the cloud
-        blob.upload_from_filename(os.path.join(
-            outputDir, baseName + ".wav"), content_type="audio/wav")
-
-        print("Transcribing...")
-        transcripts = get_transcripts_json(os.path.join(
-            "gs://", storageBucket, tmpFile), srcLang,
-            phraseHints=phraseHints,
-            speakerCount=speakerCount)
-        json.dump(transcripts, open(os.path.join(
-            outputDir, "transcript.json"), "w"))
-
-        sentences = parse_sentence_with_speaker(transcripts, srcLang)
-        fn = os.path.join(outputDir, baseName + ".json")
-        with open(fn, "w") as f:
-            json.dump(sentences, f)
-        print(f"Wrote {fn}")
-        print("Deleting cloud file...")
-        blob.delete()
-
-    srtPath = os.path.join(outputDir, "subtitles.srt") if srt else None
-    if srt:
-        transcripts = json.load(
-            open(os.path.join(outputDir, "transcript.json")))
-        subtitles = toSrt(transcripts)
-        with open(srtPath, "w") as f:
-            f.write(subtitles)
-        print(
-            f"Wrote srt subtitles to {os.path.join(outputDir, 'subtitles.srt')}")
-
-    sentences = json.load(open(os.path.join(outputDir, baseName + ".json")))
-    sentence = sentences[0]
-
-    if not noTranslate:
+    # Clients and caches, unless whoever called us is sharing theirs
+    ownShared = not shared
+    if not shared:
+        shared = Shared(cacheDir=cacheDir, ttsCacheMb=ttsCacheMb, ttsQps=ttsQps,
+                        stitchWorkers=stitchWorkers)
+    try:
+        if newDir:
+            shutil.rmtree(outputDir)
+
+        if not os.path.exists(outputDir):
+            os.mkdir(outputDir)
+
+        # How long each stage took and the API calls it made, kept up to date
+        # in metrics.json as the dub goes
+        metrics = Metrics(os.path.join(outputDir, "metrics.json"))
+
+        # Each stage below only runs if the hash of its inputs differs from the
+        # one recorded in the manifest the last time it ran
+        manifest = Manifest(outputDir)
+        videoHash = manifest.file_hash(videoFile)
+
+        # Stage 1: extract the audio
+        audioPath = os.path.join(outputDir, f"{baseName}.{audioFormat}")
+        key = hash_key(videoHash, audioFormat)
+        with metrics.stage("extract"):
+            if not manifest.is_fresh("extract", key, [audioPath], adopt=True):
+                print("Extracting audio from video")
+                decode_audio(videoFile, audioPath)
+                manifest.done("extract", key)
+                print(f"Wrote {audioPath}")
+
+        # Stage 2: transcribe it
+        transcriptPath = os.path.join(outputDir, "transcript.json")
+        key = hash_key(manifest.file_hash(audioPath), srcLang,
+                       phraseHints, speakerCount, chunkSecs)
+        with metrics.stage("transcribe"):
+            if not manifest.is_fresh("transcribe", key, [transcriptPath], adopt=True):
+                storageBucket = storageBucket if storageBucket else os.environ['STORAGE_BUCKET']
+                if not storageBucket:
+                    raise Exception(
+                        "Specify variable STORAGE_BUCKET in .env or as an arg")
+
+                print("Transcribing audio")
+                bucket = shared.storageClient.bucket(storageBucket)
+
+                if chunkSecs:
+                    transcripts = transcribe_chunked(
+                        audioPath, bucket, srcLang,
+                        phraseHints=phraseHints, speakerCount=speakerCount,
+                        maxChunkSecs=chunkSecs, workers=transcribeWorkers,
+                        client=shared.speechClient, metrics=metrics)
+                else:
+                    print("Uploading to the cloud...")
+                    tmpFile = os.path.join("tmp", str(uuid.uuid4()) + "." + audioFormat)
+                    blob = bucket.blob(tmpFile)
+                    # Temporary upload audio file to the cloud
+                    with metrics.call("storage.upload", bytesOut=os.path.getsize(audioPath)):
+                        blob.upload_from_filename(
+                            audioPath, content_type=f"audio/{audioFormat}")
+
+                    print("Transcribing...")
+                    transcripts = get_transcripts_json(os.path.join(
+                        "gs://", storageBucket, tmpFile), srcLang,
+                        phraseHints=phraseHints,
+                        speakerCount=speakerCount,
+                        client=ThrottledClient(shared.speechClient, metrics=metrics))
+                    print("Deleting cloud file...")
+                    with metrics.call("storage.delete"):
+                        blob.delete()
+                with open(transcriptPath, "w") as f:
+                    json.dump(transcripts, f)
+                manifest.done("transcribe", key)
+
+        # Stage 3: break the transcript into sentences
+        sentencesPath = os.path.join(outputDir, baseName + ".json")
+        transcriptHash = manifest.file_hash(transcriptPath)
+        key = hash_key(transcriptHash, srcLang)
+        # Loaded lazily and at most once: segmenting and captions share it
+        table = None
+        with metrics.stage("segment"):
+            if not manifest.is_fresh("segment", key, [sentencesPath], adopt=True):
+                table = WordTable.from_json(json.load(open(transcriptPath)))
+                sentences = parse_sentence_with_speaker(table, srcLang)
+                with open(sentencesPath, "w") as f:
+                    json.dump(sentences, f)
+                manifest.done("segment", key)
+                print(f"Wrote {sentencesPath}")
+
+        srtPath = os.path.join(outputDir, "subtitles.srt") if srt else None
+        with metrics.stage("srt"):
+            if srt:
+                if table is None:
+                    table = WordTable.from_json(json.load(open(transcriptPath)))
+                subtitles = toSrt(table)
+                with open(srtPath, "w") as f:
+                    f.write(subtitles)
+                print(
+                    f"Wrote srt subtitles to {os.path.join(outputDir, 'subtitles.srt')}")
+
+        sentences = json.load(open(sentencesPath))
+
+        # Stage 4: translate sentences whose source text changed, or that
+        # haven't been translated yet. Translations edited by hand are kept.
+        with metrics.stage("translate"):
+            if not noTranslate:
+                translated = manifest.items("translate")
+                translateClient = ThrottledClient(shared.translateClient, metrics=metrics)
+                memory = shared.memory
+                for lang in targetLangs:
+                    keys = [hash_key(sentence[srcLang], srcLang, lang)
+                            for sentence in sentences]
+                    # Keep translations made before this dub had a manifest
+                    if not any(item.startswith(f"{lang}/") for item in translated):
+                        for i, (sentence, key) in enumerate(zip(sentences, keys)):
+                            if lang in sentence:
+                                translated[f"{lang}/{i}"] = key
+                    todo = [i for i, (sentence, key) in enumerate(zip(sentences, keys))
+                            if lang not in sentence or translated.get(f"{lang}/{i}") != key]
+                    if not todo:
+                        continue
+                    print(f"Translating {len(todo)} sentences to {lang}")
+                    translations = translate_batch(
+                        [sentences[i][srcLang] for i in todo], lang, srcLang,
+                        client=translateClient, memory=memory)
+                    for i, translation in zip(todo, translations):
+                        sentences[i][lang] = translation
+                        translated[f"{lang}/{i}"] = keys[i]
+                stats = memory.stats()
+                metrics.info["translationMemory"] = stats
+                if stats['hits'] or stats['misses']:
+                    print(
+                        f"Translation memory: {stats['hits']} hits, {stats['misses']} misses")
+
+                # Write the translations to json
+                with open(sentencesPath, "w") as f:
+                    json.dump(sentences, f)
+                manifest.save()
+
+        # whether or not to also dub the source language
+        if dubSrc:
+            targetLangs = targetLangs + [srcLang]
+
+        # Stage 5: synthesize the clips whose text, voice or length changed
+        audioDir = os.path.join(outputDir, "audioClips")
+        synthesized = manifest.items("synthesize")
+        clipKeys = {lang: [hash_key(sentence[lang], lang, voices.get(lang),
+                                    round(sentence['end_time'] - sentence['start_time'], 3))
+                           for sentence in sentences] for lang in targetLangs}
+        todo = set()
         for lang in targetLangs:
-            print(f"Translating to {lang}")
-            for sentence in sentences:
-                sentence[lang] = translate_text(
-                    sentence[srcLang], lang, srcLang)
-
-        # Write the translations to json
-        fn = os.path.join(outputDir, baseName + ".json")
-        with open(fn, "w") as f:
-            json.dump(sentences, f)
-
-    audioDir = os.path.join(outputDir, "audioClips")
-    if not "audioClips" in outputFiles:
-        os.mkdir(audioDir)
-
-    # whether or not to also dub the source language
-    if dubSrc:
-        targetLangs += [srcLang]
-
-    for lang in targetLangs:
-        languageDir = os.path.join(audioDir, lang)
-        if os.path.exists(languageDir):
-            if not genAudio:
-                continue
-            shutil.rmtree(languageDir)
-        os.mkdir(languageDir)
-        print(f"Synthesizing audio for {lang}")
-        for i, sentence in enumerate(sentences):
-            voiceName = voices[lang] if lang in voices else None
-            audio = speakUnderDuration(
-                sentence[lang], lang, sentence['end_time'] -
-                sentence['start_time'],
-                voiceName=voiceName)
-            with open(os.path.join(languageDir, f"{i}.mp3"), 'wb') as f:
-                f.write(audio)
-
-    dubbedDir = os.path.join(outputDir, "dubbedVideos")
-
-    if not "dubbedVideos" in outputFiles:
-        os.mkdir(dubbedDir)
-
-    for lang in targetLangs:
-        print(f"Dubbing audio for {lang}")
-        outFile = os.path.join(dubbedDir, lang + ".mp4")
-        stitch_audio(sentences, os.path.join(
-            audioDir, lang), videoFile, outFile, srtPath=srtPath)
-
-    print("Done")
+            languageDir = os.path.join(audioDir, lang)
+            os.makedirs(languageDir, exist_ok=True)
+            # Keep clips made before this dub had a manifest
+            if not genAudio and not any(item.startswith(f"{lang}/") for item in synthesized):
+                for i, key in enumerate(clipKeys[lang]):
+                    if os.path.exists(os.path.join(languageDir, f"{i}.mp3")):
+                        synthesized[f"{lang}/{i}"] = key
+            for i, key in enumerate(clipKeys[lang]):
+                if genAudio or synthesized.get(f"{lang}/{i}") != key or \
+                        not os.path.exists(os.path.join(languageDir, f"{i}.mp3")):
+                    todo.add((lang, i))
+            # Remove clips left over from a run that had more sentences
+            for fn in os.listdir(languageDir):
+                if fn.endswith(".mp3") and int(fn.split('.')[0]) >= len(sentences):
+                    os.remove(os.path.join(languageDir, fn))
+
+        # Stage 6: stitch the languages whose clips, timing or options changed.
+        # Stitching is CPU bound, so it runs in a pool of processes alongside
+        # stage 5: each language is stitched as soon as its clips are ready,
+        # while the network bound synthesis of other languages carries on
+        dubbedDir = os.path.join(outputDir, "dubbedVideos")
+        os.makedirs(dubbedDir, exist_ok=True)
+        srtHash = manifest.file_hash(srtPath) if srtPath else None
+        startTimes = [sentence['start_time'] for sentence in sentences]
+        if multiTrack:
+            # Mix each language's audio once, then copy them all into one video
+            stitches = {lang: (f"mix/{lang}", hash_key(videoHash, clipKeys[lang], startTimes),
+                               os.path.join(dubbedDir, lang + ".m4a"))
+                        for lang in targetLangs}
+        else:
+            stitches = {lang: (f"stitch/{lang}", hash_key(videoHash, clipKeys[lang], startTimes,
+                                                           srtHash, streamCopy, softSubtitles),
+                               os.path.join(dubbedDir, lang + ".mp4"))
+                        for lang in targetLangs}
+        toStitch = set(lang for lang, (stage, key, fn) in stitches.items()
+                       if not manifest.is_fresh(stage, key, [fn]))
+        stitchJobs = {}
+
+        # Decode the source's soundtrack once, at full quality, for every
+        # language's mix to share (memory-mapped) instead of each decoding it
+        soundtrackPath = os.path.join(outputDir, f"{baseName}.soundtrack.wav")
+        if toStitch:
+            with metrics.stage("soundtrack"):
+                key = hash_key(videoHash)
+                if not manifest.is_fresh("soundtrack", key, [soundtrackPath]):
+                    decode_audio(videoFile, soundtrackPath, sampleRate=None, channels=None)
+                    manifest.done("soundtrack", key)
+
+        if profileStitch:
+            os.makedirs(os.path.join(outputDir, "profiles"), exist_ok=True)
+
+        def _stitch(lang):
+            if lang not in toStitch:
+                return
+            print(f"Dubbing audio for {lang}")
+            args = (sentences, os.path.join(audioDir, lang), videoFile, stitches[lang][2])
+            if multiTrack:
+                fn, kwargs = mix_audio, {"soundtrack": soundtrackPath}
+            else:
+                fn, kwargs = stitch_audio, {"srtPath": srtPath, "streamCopy": streamCopy,
+                                            "softSubtitles": softSubtitles, "srtLang": srcLang,
+                                            "soundtrack": soundtrackPath, "lang": lang}
+            stitchJobs[lang] = stitchPool.submit(
+                _stitch_worker, fn, args, kwargs, profiler=profileStitch,
+                profilePath=os.path.join(outputDir, "profiles", f"stitch_{lang}"))
+
+        stitchPool = shared.stitchPool
+        synthLangs = sorted(set(lang for lang, _ in todo))
+        for lang in targetLangs:
+            if lang not in synthLangs:
+                _stitch(lang)
+
+        # Stage 5, continued
+        with metrics.stage("synthesize"):
+            if todo:
+                print(
+                    f"Synthesizing {len(todo)} clips for {', '.join(synthLangs)}")
+                ttsCache = shared.ttsCache
+                rateModel = shared.rateModel
+                try:
+                    synthesize_audio(sentences, synthLangs, audioDir, voices=voices,
+                                     client=shared.ttsClient, workers=ttsWorkers,
+                                     bucket=shared.ttsBucket, qps=None, cache=ttsCache,
+                                     rateModel=rateModel, only=todo, onLanguageDone=_stitch,
+                                     metrics=metrics)
+                finally:
+                    rateModel.save()
+                for lang, i in todo:
+                    synthesized[f"{lang}/{i}"] = clipKeys[lang][i]
+                manifest.save()
+                stats = ttsCache.stats()
+                metrics.info["ttsCache"] = stats
+                print(f"TTS cache: {stats['hits']} hits, {stats['misses']} misses")
+
+        # Only the stitching left over once synthesis is done counts here;
+        # each language's own timings are under stitch/{lang}/
+        with metrics.stage("stitch"):
+            for lang, job in stitchJobs.items():
+                metrics.merge(job.result(), prefix=f"stitch/{lang}/")
+                stage, key, fn = stitches[lang]
+                manifest.done(stage, key)
+                if not multiTrack:
+                    print(f"Wrote {fn}")
+
+        if multiTrack:
+            tracks = [(stitches[lang][2], lang) for lang in targetLangs]
+            outFile = os.path.join(dubbedDir, f"{baseName}.{multiTrack}")
+            key = hash_key(videoHash, [clipKeys[lang] for lang in targetLangs],
+                           startTimes, targetLangs, srtHash)
+            with metrics.stage("mux"):
+                if not manifest.is_fresh("stitch", key, [outFile]):
+                    # The video is copied, so subtitles can only go in as a track
+                    mux_video(videoFile, outFile, tracks,
+                              keepOriginalAudio=True, originalLang=srcLang,
+                              subtitleTracks=[(srtPath, srcLang)] if srtPath else [])
+                    manifest.done("stitch", key)
+                    print(f"Wrote {outFile}")
+
+        metrics.save()
+    finally:
+        # Saves the caches and stops the stitch workers, even if a stage failed
+        if ownShared:
+            shared.close()
+    print(f"Done, timings in {metrics.path}")
 
 
 if __name__ == "__main__":
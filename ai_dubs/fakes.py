@@ -0,0 +1,218 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local stand-ins for the Google Cloud clients dubber.py uses, for
+benchmarking the pipeline without credentials or network. Each fake only
+implements the methods dubber.py calls, and counts every call it gets.
+"""
+
+import collections
+import datetime
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+from google.cloud import texttospeech
+
+# One frame of silence: MPEG-2 Layer III, 32 kbps, 24 kHz, mono, the
+# format Text-to-Speech returns. Each frame holds 576 samples.
+_SILENT_FRAME = bytes([0xFF, 0xF3, 0x44, 0xC0]) + bytes(92)
+_FRAME_SECS = 576 / 24000
+
+WORDS = ["the", "machine", "learning", "model", "is", "a", "really", "neat",
+         "way", "to", "dub", "videos", "into", "other", "languages", "and",
+         "it", "works", "pretty", "well", "most", "of", "time", "today"]
+
+
+class CallCounter:
+    """Thread-safe counts of API calls, shared by the fakes."""
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    def add(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+def silent_mp3(seconds):
+    """Returns about seconds of silent MP3 audio."""
+    return _SILENT_FRAME * max(1, round(seconds / _FRAME_SECS))
+
+
+def synthetic_transcript(totalSecs, sentences, speakerCount=1, sentencesPerResult=10,
+                         seed=0):
+    """Makes up a transcript in the format returned by get_transcripts_json.
+
+    Sentences are spread evenly over totalSecs, each one talking for most of
+    its slot and followed by a pause, so parse_sentence_with_speaker finds
+    exactly `sentences` sentences.
+
+    Args:
+        totalSecs (float): Length of the video
+        sentences (int): Number of sentences
+        speakerCount (int, optional): Speakers to take turns. Defaults to 1.
+        sentencesPerResult (int, optional): Sentences per Speech API result. Defaults to 10.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        list : [{"transcript": "lalala", "words": [{"word": "la", "start_time": 20, ...}]}]
+    """
+    rng = random.Random(seed)
+    slot = totalSecs / sentences
+    wordSecs = 0.4
+    wordsPerSentence = max(1, int(slot * 0.7 / wordSecs))
+    results = []
+    for i in range(sentences):
+        if i % sentencesPerResult == 0:
+            results.append({"transcript": "", "words": []})
+        speaker = i % speakerCount + 1
+        for j in range(wordsPerSentence):
+            start = i * slot + j * wordSecs
+            results[-1]["words"].append({
+                "word": rng.choice(WORDS),
+                "start_time": round(start, 3),
+                "end_time": round(start + wordSecs, 3),
+                "speaker_tag": speaker,
+            })
+    for result in results:
+        result["transcript"] = " ".join(word["word"] for word in result["words"])
+    return results
+
+
+class FakeSpeechClient:
+    """Stands in for speech.SpeechClient. Every recognize request returns
+    the same canned transcript.
+
+    Args:
+        transcript (list): What to return, in the format of get_transcripts_json
+        latency (float, optional): Seconds each request takes. Defaults to 0.
+        counter (CallCounter, optional): Where to count calls. Defaults to a new counter.
+    """
+
+    def __init__(self, transcript, latency=0, counter=None):
+        self.transcript = transcript
+        self.latency = latency
+        self.counter = counter if counter else CallCounter()
+
+    def _response(self):
+        results = []
+        for result in self.transcript:
+            words = [SimpleNamespace(
+                word=word["word"],
+                start_time=datetime.timedelta(seconds=word["start_time"]),
+                end_time=datetime.timedelta(seconds=word["end_time"]),
+                speaker_tag=word["speaker_tag"]) for word in result["words"]]
+            results.append(SimpleNamespace(alternatives=[SimpleNamespace(
+                transcript=result["transcript"], words=words)]))
+        return SimpleNamespace(results=results)
+
+    def long_running_recognize(self, config, audio):
+        self.counter.add("speech.long_running_recognize")
+        time.sleep(self.latency)
+        response = self._response()
+        return SimpleNamespace(result=lambda timeout=None: response)
+
+
+class FakeTextToSpeechClient:
+    """Stands in for texttospeech.TextToSpeechClient. Returns silence as long
+    as a voice talking at charsPerSec would take to say the text.
+
+    Args:
+        charsPerSec (float, optional): How fast the fake voice talks at speaking
+            rate 1. Defaults to 15.
+        latency (float, optional): Seconds each request takes. Defaults to 0.
+        counter (CallCounter, optional): Where to count calls. Defaults to a new counter.
+    """
+
+    def __init__(self, charsPerSec=15, latency=0, counter=None):
+        self.charsPerSec = charsPerSec
+        self.latency = latency
+        self.counter = counter if counter else CallCounter()
+
+    def synthesize_speech(self, input, voice, audio_config):
+        self.counter.add("texttospeech.synthesize_speech")
+        time.sleep(self.latency)
+        rate = audio_config.speaking_rate or 1
+        return texttospeech.SynthesizeSpeechResponse(audio_content=silent_mp3(
+            len(input.text) / self.charsPerSec / rate))
+
+
+class FakeTranslateClient:
+    """Stands in for translate.Client. "Translates" by tagging text with
+    the target language.
+
+    Args:
+        latency (float, optional): Seconds each request takes. Defaults to 0.
+        counter (CallCounter, optional): Where to count calls. Defaults to a new counter.
+    """
+
+    def __init__(self, latency=0, counter=None):
+        self.latency = latency
+        self.counter = counter if counter else CallCounter()
+
+    def translate(self, values, target_language=None, source_language=None):
+        self.counter.add("translate.translate")
+        time.sleep(self.latency)
+        single = isinstance(values, str)
+        results = [{"input": value, "translatedText": f"[{target_language}] {value}"}
+                   for value in ([values] if single else values)]
+        return results[0] if single else results
+
+
+class FakeBlob:
+    def __init__(self, name, counter):
+        self.name = name
+        self.counter = counter
+
+    def upload_from_filename(self, filename, content_type=None):
+        self.counter.add("storage.upload")
+        # Read the file like a real upload would, then throw it away
+        size = 0
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                size += len(chunk)
+        self.counter.add("storage.uploadBytes", size)
+
+    def delete(self):
+        self.counter.add("storage.delete")
+
+
+class FakeBucket:
+    def __init__(self, name, counter):
+        self.name = name
+        self.counter = counter
+
+    def blob(self, name):
+        return FakeBlob(name, self.counter)
+
+
+class FakeStorageClient:
+    """Stands in for storage.Client. Uploads are counted, then thrown away.
+
+    Args:
+        counter (CallCounter, optional): Where to count calls. Defaults to a new counter.
+    """
+
+    def __init__(self, counter=None):
+        self.counter = counter if counter else CallCounter()
+
+    def bucket(self, name):
+        return FakeBucket(name, self.counter)
@@ -0,0 +1,89 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+
+
+class Manifest:
+    """Remembers what each stage of the dubbing pipeline (extract, transcribe,
+    segment, translate, synthesize, stitch) was last run with, so a rerun only
+    redoes the stages, sentences and languages whose inputs changed.
+
+    Every stage is identified by a key: a hash of everything that affects its
+    output (see cache.hash_key). Stages that work sentence by sentence also
+    keep a key per item, i.e. per (language, sentence). The manifest is saved
+    as manifest.json in the output directory.
+
+    Args:
+        outputDir (String): The dub's output directory
+    """
+
+    FILE = "manifest.json"
+
+    def __init__(self, outputDir):
+        self.path = os.path.join(outputDir, self.FILE)
+        self.data = {"stages": {}, "items": {}, "files": {}}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.data.update(json.load(f))
+
+    def file_hash(self, path):
+        """Returns the sha256 of a file's contents. Hashes are remembered by
+        size and modification time, so big videos are only read once."""
+        stat = os.stat(path)
+        known = self.data["files"].get(os.path.abspath(path))
+        if known and known["size"] == stat.st_size and known["mtime"] == stat.st_mtime:
+            return known["hash"]
+
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(block)
+        self.data["files"][os.path.abspath(path)] = {
+            "size": stat.st_size, "mtime": stat.st_mtime, "hash": sha.hexdigest()}
+        return sha.hexdigest()
+
+    def is_fresh(self, stage, key, outputs=[], adopt=False):
+        """Whether stage already ran with these inputs and its outputs still exist.
+
+        Args:
+            stage (String): i.e. "transcribe"
+            key (String): Hash of the stage's inputs
+            outputs (String[], optional): Files the stage writes. Defaults to [].
+            adopt (bool, optional): If the stage has no record but its outputs
+                exist (i.e. they were made before manifests existed), trust
+                them and record key. Defaults to False.
+        """
+        if not all(os.path.exists(fn) for fn in outputs):
+            return False
+        if stage not in self.data["stages"] and adopt and outputs:
+            self.done(stage, key)
+        return self.data["stages"].get(stage) == key
+
+    def done(self, stage, key):
+        """Records that stage finished with inputs key."""
+        self.data["stages"][stage] = key
+        self.save()
+
+    def items(self, stage):
+        """Returns the {item: key} dict for a per-item stage. Update it in
+        place, then call save()."""
+        return self.data["items"].setdefault(stage, {})
+
+    def save(self):
+        with open(self.path + ".part", "w") as f:
+            json.dump(self.data, f)
+        os.replace(self.path + ".part", self.path)
@@ -0,0 +1,184 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+def payload_size(value):
+    """Roughly how many bytes value takes on the wire. Understands bytes,
+    strings, lists, dicts and protobuf messages; anything else counts as 0."""
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, dict):
+        return sum(payload_size(x) for x in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(payload_size(x) for x in value)
+    # proto-plus messages, used by the google-cloud clients
+    if hasattr(type(value), "pb"):
+        try:
+            return type(value).pb(value).ByteSize()
+        except TypeError:
+            return 0
+    if hasattr(value, "ByteSize"):
+        return value.ByteSize()
+    return 0
+
+
+@contextlib.contextmanager
+def profiled(profiler, path):
+    """Profiles the body of a with block.
+
+    Args:
+        profiler (String): "cprofile", which writes path + ".prof" (open it with
+            pstats or snakeviz), or "pyinstrument", which writes path + ".html"
+            (pip install pyinstrument). None to not profile.
+        path (String): Where to write the profile, without extension
+    """
+    if not profiler:
+        yield
+    elif profiler == "cprofile":
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(path + ".prof")
+    elif profiler == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise ImportError(
+                "Profiling with pyinstrument needs it installed: pip install pyinstrument")
+        profile = Profiler()
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            with open(path + ".html", "w") as f:
+                f.write(profile.output_html())
+    else:
+        raise ValueError(f"Unknown profiler {profiler}, use cprofile or pyinstrument")
+
+
+class Metrics:
+    """Collects how long each stage of a dub took, and how many calls to
+    each external API it made: their time, errors, retries and bytes sent and
+    received. Safe to use from multiple threads.
+
+    Args:
+        path (String, optional): metrics.json file to write to. If set, it's
+            rewritten every time a stage ends, so a job that crashes or is
+            killed still leaves its numbers behind. Defaults to None.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+        self.calls = {}
+        self.info = {}
+
+    def _call_stats(self, name):
+        return self.calls.setdefault(name, {
+            "calls": 0, "errors": 0, "retries": 0, "secs": 0.0, "bytesOut": 0, "bytesIn": 0})
+
+    def add_stage(self, name, secs):
+        """Adds secs of wall time to stage name."""
+        with self.lock:
+            stats = self.stages.setdefault(name, {"secs": 0.0, "count": 0})
+            stats["secs"] += secs
+            stats["count"] += 1
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Times the body of a with block as stage name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+            if self.path:
+                self.save()
+
+    @contextlib.contextmanager
+    def call(self, name, bytesOut=0):
+        """Times one external call, i.e. "storage.upload", in a with block.
+        Set bytesIn on the object it yields to count the response size."""
+        record = _Call()
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception:
+            with self.lock:
+                self._call_stats(name)["errors"] += 1
+            raise
+        finally:
+            secs = time.perf_counter() - start
+            with self.lock:
+                stats = self._call_stats(name)
+                stats["calls"] += 1
+                stats["secs"] += secs
+                stats["bytesOut"] += bytesOut
+                stats["bytesIn"] += record.bytesIn
+
+    def retry(self, name):
+        """Counts a retry of call name."""
+        with self.lock:
+            self._call_stats(name)["retries"] += 1
+
+    def merge(self, other, prefix=""):
+        """Adds in the stages and calls of another Metrics's to_dict(), i.e. one
+        collected in a worker process, with prefix added to its stage names."""
+        with self.lock:
+            for name, stats in other["stages"].items():
+                mine = self.stages.setdefault(prefix + name, {"secs": 0.0, "count": 0})
+                for key in mine:
+                    mine[key] += stats[key]
+            for name, stats in other["calls"].items():
+                mine = self._call_stats(name)
+                for key in mine:
+                    mine[key] += stats[key]
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "started": self.started,
+                "totalSecs": time.time() - self.started,
+                "stages": {name: dict(stats) for name, stats in self.stages.items()},
+                "calls": {name: dict(stats) for name, stats in self.calls.items()},
+                "info": dict(self.info),
+            }
+
+    def save(self, path=None):
+        """Writes the metrics as json to path, or to the path given when
+        this was created."""
+        path = path if path else self.path
+        data = self.to_dict()
+        with open(path + ".part", "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(path + ".part", path)
+
+
+class _Call:
+    bytesIn = 0
@@ -0,0 +1,201 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+
+# numpy types for each pydub sample width (in bytes)
+_DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+
+def segment_to_array(segment):
+    """Returns the samples of a pydub AudioSegment as a (frames, channels) array.
+    The array shares memory with the segment, so it's read-only."""
+    return np.frombuffer(segment.raw_data, dtype=_DTYPES[segment.sample_width]).reshape(
+        -1, segment.channels)
+
+
+def _sync(original, clips):
+    # Like pydub's overlay, bring everything up to the highest frame rate,
+    # channel count and sample width used by any of the segments
+    segments = [original] + clips
+    frameRate = max(x.frame_rate for x in segments)
+    channels = max(x.channels for x in segments)
+    sampleWidth = max(x.sample_width for x in segments)
+    # numpy has no 24-bit integers
+    if sampleWidth == 3:
+        sampleWidth = 4
+
+    def _convert(segment):
+        if segment.frame_rate != frameRate:
+            segment = segment.set_frame_rate(frameRate)
+        if segment.channels != channels:
+            segment = segment.set_channels(channels)
+        if segment.sample_width != sampleWidth:
+            segment = segment.set_sample_width(sampleWidth)
+        return segment
+
+    return _convert(original), [_convert(clip) for clip in clips]
+
+
+def dub_windows(positions, lengths, totalFrames):
+    """Merges the spans of time covered by dub clips into non-overlapping windows.
+
+    Args:
+        positions (np.array): First frame of each clip
+        lengths (np.array): Length of each clip in frames
+        totalFrames (int): Length of the original audio in frames
+
+    Returns:
+        (np.array, np.array) : start and end frames of each window
+    """
+    starts = np.minimum(positions, totalFrames)
+    ends = np.minimum(positions + lengths, totalFrames)
+    keep = starts < ends
+    order = np.argsort(starts[keep], kind="stable")
+    starts, ends = starts[keep][order], ends[keep][order]
+    if not len(starts):
+        return starts, ends
+
+    # A clip starts a new window if it begins after every earlier clip has ended
+    furthestEnd = np.maximum.accumulate(ends)
+    newWindow = np.concatenate(([True], starts[1:] > furthestEnd[:-1]))
+    firsts = np.flatnonzero(newWindow)
+    lasts = np.append(firsts[1:] - 1, len(starts) - 1)
+    return starts[firsts], furthestEnd[lasts]
+
+
+def mix_blocks(original, clips, positions, overlayGain=-30, blockFrames=1024 * 1024):
+    """Overlays dub clips on top of the original soundtrack, one block of
+    frames at a time, so only a block (not the whole mixed soundtrack) is
+    ever held in memory. original can be a read-only memory-mapped array.
+
+    Gives the same samples as calling pydub's overlay with
+    gain_during_overlay once per clip, in the order clips are given: each
+    clip ducks everything already mixed under it by overlayGain, so where
+    clips overlap, the earlier ones are ducked along with the original.
+
+    Args:
+        original (np.array): (frames, channels) samples of the soundtrack
+        clips (np.array[]): (frames, channels) samples of each clip, in the
+            same sample rate, channel count and type as original
+        positions (np.array): First frame of each clip
+        overlayGain (int, optional): How quiet to make the original audio
+            under the dubs, in dB. Defaults to -30.
+        blockFrames (int, optional): Frames per block. Defaults to 1M.
+
+    Yields:
+        np.array : Consecutive (frames, channels) blocks of the mixed soundtrack
+    """
+    limits = np.iinfo(original.dtype)
+    totalFrames = len(original)
+    positions = np.asarray(positions, dtype=np.int64)
+    lengths = np.array([len(x) for x in clips], dtype=np.int64)
+    windowStarts, windowEnds = dub_windows(positions, lengths, totalFrames)
+    gain = 10 ** (overlayGain / 20) if overlayGain else 1
+
+    order = np.argsort(positions, kind="stable")
+    sortedPositions = positions[order]
+    longest = lengths.max() if len(lengths) else 0
+
+    for blockStart in range(0, totalFrames, blockFrames):
+        blockEnd = min(blockStart + blockFrames, totalFrames)
+        block = np.array(original[blockStart:blockEnd])
+        firstWindow = np.searchsorted(windowEnds, blockStart, side="right")
+        lastWindow = np.searchsorted(windowStarts, blockEnd, side="left")
+        if firstWindow == lastWindow:
+            # No dubs here, so the original passes through untouched
+            yield block
+            continue
+
+        mixed = block.astype(np.float64)
+        # Clips that play during this block, in the order they're given, like
+        # repeated overlay calls
+        first, last = np.searchsorted(
+            sortedPositions, [blockStart - longest, blockEnd], side="left")
+        for i in np.sort(order[first:last]):
+            clipStart = max(positions[i], blockStart)
+            clipEnd = min(positions[i] + lengths[i], blockEnd)
+            if clipStart >= clipEnd:
+                continue
+            span = slice(clipStart - blockStart, clipEnd - blockStart)
+            # pydub's audioop.mul floors after scaling and audioop.add
+            # saturates, so we do too
+            ducked = np.clip(np.floor(mixed[span] * gain), limits.min, limits.max)
+            mixed[span] = np.clip(ducked + clips[i][clipStart - positions[i]:
+                                                    clipEnd - positions[i]],
+                                  limits.min, limits.max)
+        yield mixed.astype(original.dtype)
+
+
+def mix_dubs(original, clips, positionsMs, overlayGain=-30):
+    """Overlays dub clips on top of the original soundtrack.
+
+    Gives the same result as calling
+    original.overlay(clip, position=ms, gain_during_overlay=overlayGain) once
+    per clip, in order, overlapping clips included, but without copying the
+    whole soundtrack for every clip: the spans covered by clips are found in
+    one vectorized pass, and only samples inside them are ducked and mixed
+    (see mix_blocks).
+
+    Args:
+        original (AudioSegment): Original soundtrack
+        clips (AudioSegment[]): Dubbed audio clips
+        positionsMs (float[]): Where to start each clip, in milliseconds
+        overlayGain (int, optional): How quiet to make the original audio
+            under the dubs, in dB. Defaults to -30.
+
+    Returns:
+        AudioSegment : The mixed soundtrack
+    """
+    original, clips = _sync(original, list(clips))
+    if not clips:
+        return original
+    positions = [int(original.frame_count(ms=ms)) for ms in positionsMs]
+    blocks = mix_blocks(segment_to_array(original), [segment_to_array(clip) for clip in clips],
+                        positions, overlayGain=overlayGain)
+    return original._spawn(b"".join(block.tobytes() for block in blocks))
+
+
+def open_wav(path):
+    """Memory-maps the samples of a 16-bit PCM wav file, read-only, so many
+    processes can share one copy of a long soundtrack through the page cache.
+
+    Returns:
+        (np.memmap, int) : (frames, channels) samples, and the sample rate
+    """
+    with open(path, "rb") as f:
+        if f.read(4) != b"RIFF" or f.read(8)[4:] != b"WAVE":
+            raise ValueError(f"{path} isn't a wav file")
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f"{path} has no data chunk")
+            chunkId, size = header[:4], int.from_bytes(header[4:], "little")
+            if chunkId == b"fmt ":
+                fmt = f.read(size)
+                channels = int.from_bytes(fmt[2:4], "little")
+                frameRate = int.from_bytes(fmt[4:8], "little")
+                if int.from_bytes(fmt[14:16], "little") != 16:
+                    raise ValueError(f"{path} isn't 16-bit")
+                f.seek(size % 2, 1)
+            elif chunkId == b"data":
+                offset = f.tell()
+                break
+            else:
+                f.seek(size + size % 2, 1)
+    frames = size // (2 * channels)
+    if not frames:
+        return np.zeros((0, channels), dtype=np.int16), frameRate
+    return np.memmap(path, dtype=np.int16, mode="r", offset=offset,
+                     shape=(frames, channels)), frameRate
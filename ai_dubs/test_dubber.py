@@ -0,0 +1,34 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Checks for dubber.py's transcript handling. Run them with:
+
+    python -m pytest test_dubber.py
+"""
+
+from dubber import parse_sentence_with_speaker, toSrt
+
+# Transcripts of a silent or music-only video: no results at all, or
+# results without any words
+EMPTY_TRANSCRIPTS = [[], [{"transcript": "", "words": []}]]
+
+
+def test_parse_sentence_with_speaker_empty():
+    for transcripts in EMPTY_TRANSCRIPTS:
+        assert parse_sentence_with_speaker(transcripts, "en") == []
+
+
+def test_toSrt_empty():
+    for transcripts in EMPTY_TRANSCRIPTS:
+        assert toSrt(transcripts) == ""
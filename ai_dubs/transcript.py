@@ -0,0 +1,110 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+
+
+class WordTable:
+    """Every word of a transcript stored column by column in NumPy arrays, so
+    that splitting it into sentences or caption lines is a handful of
+    vectorized operations rather than a Python loop over every word.
+
+    Words are interned: each distinct word is stored once in vocab, and
+    codes holds the index of every word in it.
+
+    Attributes:
+        vocab (np.array): Distinct words (strings)
+        codes (np.array): Index into vocab of each word
+        start (np.array): Start time of each word in seconds
+        end (np.array): End time of each word in seconds
+        speaker (np.array): Speaker tag of each word
+        section (np.array): Which result of the Speech API each word came from
+    """
+
+    def __init__(self, vocab, codes, start, end, speaker, section):
+        self.vocab = vocab
+        self.codes = codes
+        self.start = start
+        self.end = end
+        self.speaker = speaker
+        self.section = section
+
+    @classmethod
+    def from_json(cls, transcripts):
+        """Builds a table from the output of get_transcripts_json."""
+        words = [word for result in transcripts for word in result['words']]
+        vocab = {}
+        codes = np.fromiter((vocab.setdefault(word['word'], len(vocab)) for word in words),
+                            dtype=np.int32, count=len(words))
+        return cls(
+            np.array(list(vocab), dtype=object),
+            codes,
+            np.fromiter((word['start_time'] for word in words),
+                        dtype=np.float64, count=len(words)),
+            np.fromiter((word['end_time'] for word in words),
+                        dtype=np.float64, count=len(words)),
+            np.fromiter((word['speaker_tag'] for word in words),
+                        dtype=np.int32, count=len(words)),
+            np.repeat(np.arange(len(transcripts), dtype=np.int32),
+                      [len(result['words']) for result in transcripts]))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def words(self, vocab=None):
+        """Returns every word as an array of strings. Pass vocab to substitute
+        a transformed vocabulary, i.e. with Japanese pronunciations removed."""
+        return (self.vocab if vocab is None else vocab)[self.codes]
+
+    def sentence_starts(self):
+        """Finds the first word of every sentence. A sentence ends when the
+        speaker changes, when there's any pause between words, or at the end
+        of a Speech API result.
+
+        Returns:
+            np.array : Index of the first word of each sentence
+        """
+        if not len(self):
+            return np.zeros(0, dtype=np.int64)
+        breaks = np.ones(len(self), dtype=bool)
+        breaks[1:] = (self.section[1:] != self.section[:-1]) | \
+            (self.speaker[1:] != self.speaker[:-1]) | \
+            (self.end[:-1] < self.start[1:])
+        return np.flatnonzero(breaks)
+
+    def line_starts(self, charsPerLine=60):
+        """Packs words into caption lines. Each word adds its length plus a
+        space to the line, and a line ends with the first word that takes it
+        past charsPerLine characters.
+
+        Returns:
+            np.array : Index of the first word of each line
+        """
+        if not len(self):
+            return np.zeros(0, dtype=np.int64)
+        lengths = np.array([len(word) + 1 for word in self.vocab],
+                           dtype=np.int64)[self.codes]
+        total = np.cumsum(lengths)
+        before = np.concatenate(([0], total[:-1]))
+        # For every word, where the next line would start if a line started
+        # there: just after the first word that pushes it past the limit
+        nextStart = (np.searchsorted(total, before + charsPerLine, side="right") + 1).tolist()
+
+        # Then follow the chain from the first word, one step per line
+        starts = []
+        first = 0
+        while first < len(self):
+            starts.append(first)
+            first = nextStart[first]
+        return np.array(starts, dtype=np.int64)
@@ -0,0 +1,257 @@
+#  * Copyright 2020 Google LLC
+#  *
+#  * Licensed under the Apache License, Version 2.0 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  *      http://www.apache.org/licenses/LICENSE-2.0
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""A small local index of what the clothes in your closet look like, used
+to guess which inspiration pics are worth a (paid) Product Search query
+before making it. Each closet image is boiled down to a color histogram and
+a perceptual hash, and a pic is compared against all of them at once with
+one matrix multiply.
+
+Build it from your closet directory (product_set_from_dir.py does this too):
+
+    python closet_index.py
+"""
+
+import hashlib
+import io
+import json
+import os
+import numpy as np
+from PIL import Image
+from outfits import GROUP_INDEX
+
+# Hue, saturation and value bins of the color histograms
+HSV_BINS = (8, 4, 4)
+# Images are shrunk to this size before anything else, for speed
+THUMBNAIL_SIZE = (256, 256)
+# Images whose hashes differ in at most this many of their 64 bits are
+# (nearly) the same picture
+NEAR_DUPLICATE_BITS = 6
+# ...as long as their hashes have at least this many bits set and unset.
+# Flat, featureless images all hash to nearly all zeros.
+MIN_HASH_BITS = 8
+
+
+def _openImage(image):
+    if isinstance(image, Image.Image):
+        return image
+    if isinstance(image, (bytes, bytearray)):
+        image = io.BytesIO(image)
+    # convert() returns a loaded copy, so the file can be closed right away
+    with Image.open(image) as opened:
+        opened.draft("RGB", THUMBNAIL_SIZE)  # Decodes jpegs at reduced size, which is much faster
+        image = opened.convert("RGB")
+    image.thumbnail(THUMBNAIL_SIZE)
+    return image
+
+
+def colorHistogram(image):
+    """Histogram of an image's colors in HSV space, normalized so that the
+    dot product of two histograms is their Bhattacharyya coefficient: 1 for
+    identical color distributions, 0 for ones with no colors in common."""
+    hsv = np.asarray(image.convert("HSV"), dtype=np.int64).reshape(-1, 3)
+    bins = np.array(HSV_BINS)
+    cells = hsv * bins // 256
+    index = (cells[:, 0] * bins[1] + cells[:, 1]) * bins[2] + cells[:, 2]
+    counts = np.bincount(index, minlength=bins.prod()).astype(np.float32)
+    return np.sqrt(counts / max(counts.sum(), 1))
+
+
+def differenceHash(image):
+    """64 bit perceptual hash of an image: whether each pixel of a 9x8
+    grayscale thumbnail is brighter than its right-hand neighbor."""
+    pixels = np.asarray(image.convert("L").resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return np.packbits(bits).view(">u8")[0]
+
+
+def imageFeatures(image, boxes=[None]):
+    """Describes an image, or parts of it.
+
+    Args:
+        image (String, bytes or PIL.Image): Path or contents of the image
+        boxes (list, optional): Parts of the image to describe, each one None for the
+            whole image or (left, top, right, bottom) as fractions of its width and height.
+            Defaults to [None].
+
+    Returns:
+        tuple : (histograms, hashes), arrays with one row per box
+    """
+    image = _openImage(image)
+    width, height = image.size
+    histograms = np.zeros((len(boxes), int(np.prod(HSV_BINS))), dtype=np.float32)
+    hashes = np.zeros(len(boxes), dtype=np.uint64)
+    for i, box in enumerate(boxes):
+        crop = image
+        if box:
+            left, top, right, bottom = box
+            crop = image.crop((int(left * width), int(top * height),
+                               max(int(right * width), int(left * width) + 1),
+                               max(int(bottom * height), int(top * height) + 1)))
+        histograms[i] = colorHistogram(crop)
+        hashes[i] = differenceHash(crop)
+    return histograms, hashes
+
+
+def _bitCount(hashes):
+    return np.unpackbits(hashes.view(np.uint8).reshape(hashes.shape + (8,)), axis=-1).sum(
+        axis=-1)
+
+
+def _nearDuplicates(a, b):
+    # Whether each hash in a is a near duplicate of each hash in b
+    distinctive = lambda hashes: np.abs(_bitCount(hashes) - 32) <= 32 - MIN_HASH_BITS
+    close = _bitCount(np.bitwise_xor(a[:, None], b[None, :])) <= NEAR_DUPLICATE_BITS
+    return close & distinctive(a)[:, None] & distinctive(b)[None, :]
+
+
+class ClosetIndex:
+    """Color histograms and hashes of every reference image in a closet,
+    with which product each came from.
+
+    Args:
+        products (list): Product ids (closet folder names)
+        labels (list): Type label of each product, i.e. "shoe"
+        imageProducts (np.array): Index into products of each image
+        histograms (np.array): Color histogram of each image (see colorHistogram)
+        hashes (np.array): Perceptual hash of each image (see differenceHash)
+    """
+
+    def __init__(self, products, labels, imageProducts, histograms, hashes):
+        # Images are kept grouped by product, so per-product results are
+        # a reduceat over each product's slice
+        order = np.argsort(imageProducts, kind="stable")
+        self.products = list(products)
+        self.labels = list(labels)
+        self.imageProducts = np.asarray(imageProducts)[order]
+        self.histograms = np.asarray(histograms, dtype=np.float32)[order]
+        self.hashes = np.asarray(hashes, dtype=np.uint64)[order]
+        self.groups = np.array([GROUP_INDEX.get(label.lower(), -1) for label in self.labels],
+                               dtype=np.int64)
+        self.starts = np.searchsorted(self.imageProducts, np.arange(len(self.products)))
+        # Changes whenever the closet does, i.e. when clothes are added
+        digest = hashlib.sha256()
+        for part in (json.dumps([self.products, self.labels]).encode(), self.imageProducts,
+                     self.histograms, self.hashes):
+            digest.update(part if isinstance(part, bytes) else part.tobytes())
+        self.version = digest.hexdigest()[:16]
+
+    @classmethod
+    def build(cls, closetDir, getLabel):
+        """Indexes every image in a closet directory laid out like
+        product_set_from_dir.py expects: one folder of images per product.
+
+        Args:
+            closetDir (String): The closet directory
+            getLabel (function): Gets a product's type label from its folder name
+        """
+        products, labels, imageProducts, histograms, hashes = [], [], [], [], []
+        for folder in sorted(os.listdir(closetDir)):
+            imgFolder = os.path.join(closetDir, folder)
+            if not os.path.isdir(imgFolder):
+                continue
+            images = []
+            for img in sorted(os.listdir(imgFolder)):
+                try:
+                    images.append(imageFeatures(os.path.join(imgFolder, img)))
+                except OSError:
+                    print(f"Couldn't index image {imgFolder}/{img}")
+            if not images:
+                continue
+            for histogram, imageHash in images:
+                imageProducts.append(len(products))
+                histograms.append(histogram[0])
+                hashes.append(imageHash[0])
+            products.append(folder)
+            labels.append(getLabel(folder))
+        return cls(products, labels, np.array(imageProducts, dtype=np.int64),
+                   np.array(histograms, dtype=np.float32).reshape(-1, int(np.prod(HSV_BINS))),
+                   np.array(hashes, dtype=np.uint64))
+
+    def save(self, path):
+        np.savez_compressed(path, products=np.array(self.products), labels=np.array(self.labels),
+                            imageProducts=self.imageProducts, histograms=self.histograms,
+                            hashes=self.hashes)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["products"].tolist(), data["labels"].tolist(), data["imageProducts"],
+                   data["histograms"], data["hashes"])
+
+    def similarity(self, histograms, hashes, labels=None):
+        """Scores how much each query looks like each product: the best
+        Bhattacharyya coefficient between the query's color histogram and
+        any of the product's images, or 1 if it's a near duplicate of one.
+
+        Args:
+            histograms (np.array): Query color histograms, one row per query
+            hashes (np.array): Query perceptual hashes
+            labels (list, optional): Query labels, i.e. the Vision API object names
+                "Shorts" or "Shoe". Products of a different type score 0. Labels that
+                aren't in outfits.MATCH_GROUPS match any product.
+
+        Returns:
+            np.array : (queries x products) similarities between 0 and 1
+        """
+        if not len(self.products):
+            return np.zeros((len(histograms), 0), dtype=np.float32)
+        perImage = histograms @ self.histograms.T
+        perImage[_nearDuplicates(np.asarray(hashes, dtype=np.uint64), self.hashes)] = 1
+        scores = np.maximum.reduceat(perImage, self.starts, axis=1)
+        if labels is not None:
+            groups = np.array([GROUP_INDEX.get(label.lower(), -1) for label in labels])
+            mismatch = (groups[:, None] >= 0) & (groups[:, None] != self.groups[None, :])
+            scores[mismatch] = 0
+        return scores
+
+    def candidates(self, image, boxes=[None], labels=None, k=5):
+        """Finds the closet products most like an image, or like each item
+        in it.
+
+        Args:
+            image (String, bytes or PIL.Image): Path or contents of the image
+            boxes (list, optional): Items to look up, as (left, top, right, bottom)
+                fractions (see utils.clothingBoxes), or None for the whole image.
+                Defaults to [None].
+            labels (list, optional): Type label of each box, to only compare against
+                products of the same type
+            k (int, optional): Products to return per box. Defaults to 5.
+
+        Returns:
+            list : [[(product, similarity)]], the best k products for each box, best first
+        """
+        scores = self.similarity(*imageFeatures(image, boxes), labels=labels)
+        best = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+        return [[(self.products[j], float(row[j])) for j in top]
+                for row, top in zip(scores, best)]
+
+    def photoSimilarity(self, image, boxes=[None], labels=None):
+        """How likely Product Search is to find something in the closet for
+        an image: the best similarity of any of its items to any product.
+        Returns 0 if there are no boxes (i.e. the Vision API found no clothes
+        in the image)."""
+        if not len(boxes):
+            return 0.0
+        scores = self.similarity(*imageFeatures(image, boxes), labels=labels)
+        return float(scores.max()) if scores.size else 0.0
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    from product_set_from_dir import getLabel
+    index = ClosetIndex.build(os.getenv("CLOSET_DIR"), getLabel)
+    index.save(os.getenv("CLOSET_INDEX", "closet_index.npz"))
+    print(f"Indexed {len(index.hashes)} images of {len(index.products)} products")
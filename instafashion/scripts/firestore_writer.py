@@ -0,0 +1,197 @@
+#  * Copyright 2020 Google LLC
+#  *
+#  * Licensed under the Apache License, Version 2.0 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  *      http://www.apache.org/licenses/LICENSE-2.0
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""Writes lots of documents to Firestore in batches, instead of one round
+trip per document:
+
+    with BatchWriter(db, db.collection(u'outfits')) as writer:
+        for srcId, fsMatch in ...:
+            writer.set(srcId, fsMatch)
+
+To try it without touching a real database, start the Firestore emulator
+and point the client at it:
+
+    gcloud beta emulators firestore start --host-port=localhost:8080
+    export FIRESTORE_EMULATOR_HOST=localhost:8080
+    python firestore_writer.py
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core import exceptions
+
+# The most writes Firestore allows in one batch
+MAX_BATCH_SIZE = 500
+
+RETRYABLE_ERRORS = (exceptions.ServiceUnavailable, exceptions.DeadlineExceeded,
+                    exceptions.Aborted, exceptions.InternalServerError)
+
+
+class BatchWriter:
+    """Collects documents to write and commits them in batches, several
+    batches at a time. Documents are upserted by id (set() replaces the
+    whole document), so writing the same documents again, i.e. when
+    rerunning the notebook, gives the same result as writing them once.
+    Safe to use from multiple threads.
+
+    Args:
+        client (firestore.Client): Client to commit batches with
+        collection (CollectionReference): Collection to write documents to
+        batchSize (int, optional): Writes per commit, at most 500. Defaults to 500.
+        flushSecs (float, optional): Longest a write waits before it's committed, even
+            if its batch isn't full. Defaults to 5.
+        workers (int, optional): Batches to commit at once. Defaults to 4.
+        retries (int, optional): Times to retry a commit that failed with a
+            temporary error. Defaults to 3.
+        onCommit (function, optional): Called with the ids of the documents in each
+            batch once it's committed, from the thread that committed it.
+    """
+
+    def __init__(self, client, collection, batchSize=MAX_BATCH_SIZE, flushSecs=5, workers=4,
+                 retries=3, onCommit=None):
+        if not 0 < batchSize <= MAX_BATCH_SIZE:
+            raise Exception(f"batchSize must be between 1 and {MAX_BATCH_SIZE}")
+        self.client = client
+        self.collection = collection
+        self.batchSize = batchSize
+        self.flushSecs = flushSecs
+        self.retries = retries
+        self.onCommit = onCommit
+        # Reentrant, because a commit that's already done calls _done right away
+        self.lock = threading.RLock()
+        self.pending = {}
+        self.pendingSince = None
+        # docId -> future of the commit it's in, so two writes to the same
+        # document are never committed at the same time, in any order
+        self.inFlight = {}
+        self.errors = []
+        self.stats = {"writes": 0, "commits": 0, "commitSecs": 0.0}
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._flushPeriodically, daemon=True)
+        self.flusher.start()
+
+    def set(self, docId, data):
+        """Queues data to be written as document docId, replacing a queued
+        write to the same document."""
+        with self.lock:
+            if self.closed.is_set():
+                raise Exception("BatchWriter is closed")
+            if not self.pending:
+                self.pendingSince = time.time()
+            self.pending[docId] = data
+            if len(self.pending) >= self.batchSize:
+                self._flush()
+
+    def flush(self):
+        """Starts committing everything queued so far."""
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.pending:
+            return
+        writes, self.pending = self.pending, {}
+        waitFor = {self.inFlight[docId] for docId in writes if docId in self.inFlight}
+        future = self.pool.submit(self._commit, writes, waitFor)
+        for docId in writes:
+            self.inFlight[docId] = future
+        future.add_done_callback(lambda _: self._done(writes, future))
+
+    def _done(self, writes, future):
+        with self.lock:
+            for docId in writes:
+                if self.inFlight.get(docId) is future:
+                    del self.inFlight[docId]
+
+    def _commit(self, writes, waitFor):
+        for earlier in waitFor:
+            earlier.exception()
+        start = time.perf_counter()
+        for attempt in range(self.retries + 1):
+            batch = self.client.batch()
+            for docId, data in writes.items():
+                batch.set(self.collection.document(docId), data)
+            try:
+                batch.commit()
+                break
+            except RETRYABLE_ERRORS as error:
+                if attempt == self.retries:
+                    self._failed(writes, error)
+                    return
+                time.sleep(2 ** attempt)
+            except Exception as error:
+                self._failed(writes, error)
+                return
+        with self.lock:
+            self.stats["writes"] += len(writes)
+            self.stats["commits"] += 1
+            self.stats["commitSecs"] += time.perf_counter() - start
+        if self.onCommit:
+            self.onCommit(list(writes))
+
+    def _failed(self, writes, error):
+        print(f"Couldn't write {len(writes)} documents: {error}")
+        with self.lock:
+            self.errors.append((list(writes), error))
+
+    def _flushPeriodically(self):
+        while not self.closed.wait(min(self.flushSecs, 1)):
+            with self.lock:
+                if self.pending and time.time() - self.pendingSince >= self.flushSecs:
+                    self._flush()
+
+    def close(self):
+        """Commits everything left and waits for every commit to finish.
+        Raises an exception if any documents couldn't be written."""
+        with self.lock:
+            self.closed.set()
+            self._flush()
+        self.pool.shutdown(wait=True)
+        self.flusher.join()
+        if self.errors:
+            failed = sum(len(docIds) for docIds, _ in self.errors)
+            raise Exception(f"Couldn't write {failed} documents, the first error was: "
+                            f"{self.errors[0][1]}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    # Writes test documents to the Firestore emulator, twice, and checks
+    # they all came out right
+    from google.cloud import firestore
+    if not os.getenv("FIRESTORE_EMULATOR_HOST"):
+        raise Exception("Set FIRESTORE_EMULATOR_HOST to test against the emulator, "
+                        "not a real database")
+    db = firestore.Client()
+    collection = db.collection(u'batchWriterTest')
+    numDocs = 1234
+    for run in range(2):
+        start = time.time()
+        with BatchWriter(db, collection) as writer:
+            for i in range(numDocs):
+                writer.set(f"doc{i}", {"i": i, "score1": i / numDocs})
+        print(f"Wrote {writer.stats['writes']} documents in {writer.stats['commits']} "
+              f"commits, {time.time() - start:.2f}s")
+    docs = {doc.id: doc.to_dict() for doc in collection.stream()}
+    assert len(docs) == numDocs, f"Found {len(docs)} documents, expected {numDocs}"
+    assert all(docs[f"doc{i}"]["i"] == i for i in range(numDocs))
+    print("All documents written once, correctly")
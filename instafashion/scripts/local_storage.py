@@ -0,0 +1,81 @@
+#  * Copyright 2020 Google LLC
+#  *
+#  * Licensed under the Apache License, Version 2.0 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  *      http://www.apache.org/licenses/LICENSE-2.0
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""A stand-in for storage.Client that serves "buckets" from folders on
+disk, so pipeline.py can be run against local pictures. Each subfolder of
+rootDir is a bucket, and files in it are its blobs. Only what pipeline.py
+uses is implemented.
+"""
+
+import os
+
+
+class LocalBucket:
+    def __init__(self, name):
+        self.name = name
+
+
+class LocalBlob:
+    """A file in a local bucket. Like a real blob, its generation changes
+    whenever the file is overwritten (it's the file's modification time)."""
+
+    def __init__(self, bucket, name, path):
+        self.bucket = bucket
+        self.name = name
+        self.path = path
+        stat = os.stat(path)
+        self.generation = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.public_url = "file://" + os.path.abspath(path)
+
+    def download_as_string(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    download_as_bytes = download_as_string
+
+
+class LocalStorageClient:
+    """Stands in for storage.Client.
+
+    Args:
+        rootDir (String): Folder whose subfolders are buckets
+    """
+
+    def __init__(self, rootDir):
+        self.rootDir = rootDir
+
+    def bucket(self, name):
+        return LocalBucket(name)
+
+    def list_blobs(self, bucket_or_name, prefix=None, page_size=None):
+        """Yields every file in a bucket whose name starts with prefix, in
+        name order, walking the folder lazily like the real client pages
+        through a listing."""
+        bucket = bucket_or_name if isinstance(bucket_or_name, LocalBucket) \
+            else LocalBucket(bucket_or_name)
+        bucketDir = os.path.join(self.rootDir, bucket.name)
+        prefix = prefix if prefix else ""
+
+        def _walk(folder, name):
+            for entry in sorted(os.scandir(folder), key=lambda entry: entry.name):
+                entryName = name + entry.name
+                if entry.is_dir():
+                    # Only go into folders that could hold names with prefix
+                    if (entryName + "/").startswith(prefix[:len(entryName) + 1]):
+                        yield from _walk(entry.path, entryName + "/")
+                elif entryName.startswith(prefix):
+                    yield LocalBlob(bucket, entryName, entry.path)
+
+        return _walk(bucketDir, "")
@@ -0,0 +1,266 @@
+#  * Copyright 2020 Google LLC
+#  *
+#  * Licensed under the Apache License, Version 2.0 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  *      http://www.apache.org/licenses/LICENSE-2.0
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""Turns Product Search results for inspiration pics into outfits from
+your closet, and scores them. This is the logic walked through in
+getMatches.ipynb, done for every pic at once: all of the matches go into
+one table, and picking the best match for each item, the rules for what
+makes an outfit and both score functions are pandas operations over the
+whole table.
+
+    responses = {uri: productSet.search("apparel", image_uri=uri) for uri in uris}
+    outfitItems, scores = getOutfits(responses)
+"""
+
+import numpy as np
+import pandas as pd
+
+# The API sometimes uses different names for similar items, so everything
+# in a single match group is treated as more or less synonymous
+MATCH_GROUPS = [("skirt", "miniskirt"),
+                ("jeans", "pants"),
+                ("shorts",),
+                ("jacket", "vest", "outerwear", "coat", "suit"),
+                ("top", "shirt"),
+                ("dress",),
+                ("swimwear", "underpants"),
+                ("footwear", "shoe", "sandal", "boot", "high heels"),
+                ("handbag", "suitcase", "satchel", "backpack", "briefcase"),
+                ("sunglasses", "glasses"),
+                ("bracelet",),
+                ("scarf", "bowtie", "tie"),
+                ("earrings",),
+                ("necklace",),
+                ("sock",),
+                ("hat", "cowboy hat", "straw hat", "fedora", "sun hat", "sombrero")]
+
+# label -> index of its match group
+GROUP_INDEX = {label: i for i, group in enumerate(MATCH_GROUPS) for label in group}
+SHOE_GROUP = GROUP_INDEX["shoe"]
+
+# You only wear one of these at a time
+BOTTOMS = {"pants", "skirt", "shorts", "dress"}
+
+MATCH_COLUMNS = ["photo", "item", "itemLabel", "itemScore", "product", "productName",
+                 "productLabel", "score", "image"]
+
+
+def typeGroup(labels):
+    """Looks up the match group of every label, or -1 for labels in no group.
+
+    Args:
+        labels (pd.Series): Labels, in any case
+
+    Returns:
+        np.array : Group index of each label
+    """
+    # There are only a few distinct labels, so each is looked up once
+    codes, uniques = pd.factorize(labels)
+    groups = np.array([GROUP_INDEX.get(label.lower(), -1) for label in uniques] + [-1],
+                      dtype=np.int64)
+    return groups[codes]
+
+
+def isTypeMatch(label1, label2):
+    """Whether two labels are roughly equivalent."""
+    group = GROUP_INDEX.get(label1.lower(), -1)
+    return group >= 0 and group == GROUP_INDEX.get(label2.lower(), -2)
+
+
+def matchTable(responses):
+    """Flattens Product Search results into one table, with a row for every
+    closet product matched to every item found in every inspiration pic.
+
+    Args:
+        responses (dict): {photo uri: productSet.search() response}
+
+    Returns:
+        pd.DataFrame : Columns photo, item (index of the item in its photo), itemLabel,
+            itemScore, product, productName, productLabel (the product's "type" label),
+            score and image. photo is categorical, ordered like responses.
+    """
+    photos, items, itemLabels, itemScores, productCodes, scores, images = \
+        [], [], [], [], [], [], []
+    codes = {}
+    products = []
+    for photo, response in enumerate(responses.values()):
+        for i, item in enumerate(response):
+            for match in item['matches']:
+                product = match['product']
+                code = codes.get(id(product))
+                if code is None:
+                    code = codes[id(product)] = len(products)
+                    products.append(product)
+                photos.append(photo)
+                items.append(i)
+                itemLabels.append(item['label'])
+                itemScores.append(item['score'])
+                productCodes.append(code)
+                scores.append(match['score'])
+                images.append(match['image'])
+
+    # The same closet products come up again and again, so their names and
+    # labels are looked up once each
+    productCodes = np.array(productCodes, dtype=np.int64)
+    productColumn = np.empty(len(products), dtype=object)
+    productColumn[:] = products
+    return pd.DataFrame({
+        "photo": pd.Categorical.from_codes(photos, categories=list(responses)),
+        "item": np.array(items, dtype=np.int64),
+        "itemLabel": itemLabels,
+        "itemScore": np.array(itemScores, dtype=np.float64),
+        "product": productColumn[productCodes],
+        "productName": np.array([product.displayName for product in products],
+                                dtype=object)[productCodes],
+        "productLabel": np.array([product.labels['type'] for product in products],
+                                 dtype=object)[productCodes],
+        "score": np.array(scores, dtype=np.float64),
+        "image": images,
+    }, columns=MATCH_COLUMNS)
+
+
+def bestMatches(table):
+    """Keeps only the highest scoring match for each item in each pic, out
+    of the matches of the same type as the item (so a dress is never
+    recommended as a match for a shirt). Items with no match of their type
+    are dropped.
+
+    Args:
+        table (pd.DataFrame): From matchTable()
+
+    Returns:
+        pd.DataFrame : At most one row per photo and item, ordered by photo and item
+    """
+    group = typeGroup(table["itemLabel"])
+    viable = table[(group >= 0) & (group == typeGroup(table["productLabel"]))]
+    # Sort by photo, item and then score, highest first; the sort is
+    # stable, so ties go to the match the API listed first
+    photo = viable["photo"].cat.codes.to_numpy()
+    item = viable["item"].to_numpy()
+    order = np.lexsort((-viable["score"].to_numpy(), item, photo))
+    photo, item = photo[order], item[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (photo[1:] != photo[:-1]) | (item[1:] != item[:-1])
+    return viable.iloc[order[first]]
+
+
+def buildOutfits(best):
+    """Makes an outfit for each pic out of its best matches, adding them
+    highest score first and skipping any that would break the rules of
+    fashion: no two items of the same type, only one bottom (pants, skirt,
+    shorts or dress), and no top on top of a dress.
+
+    Args:
+        best (pd.DataFrame): From bestMatches()
+
+    Returns:
+        pd.DataFrame : The matches in each outfit, ordered by photo and then score
+    """
+    clothes = best.sort_values(["photo", "score"], ascending=[True, False],
+                               kind="mergesort").reset_index(drop=True)
+    photo = clothes["photo"]
+    kind = clothes["productLabel"].str.lower()
+    rank = clothes.groupby("photo", observed=True).cumcount()
+
+    # Adding items one at a time, an item is rejected only because of one
+    # that was accepted before it. So of each type, only the first can get
+    # in; of the bottoms, only the first bottom; and a top only if it comes
+    # before that bottom, if that bottom is a dress.
+    firstOfKind = ~pd.DataFrame({"photo": photo, "kind": kind}).duplicated()
+    isBottom = kind.isin(BOTTOMS)
+    firstBottom = isBottom & ~photo.where(isBottom).duplicated()
+    dressRank = rank.where(firstBottom & (kind == "dress")).groupby(
+        photo, observed=False).transform("min").fillna(np.inf)
+    accepted = firstOfKind & (~isBottom | firstBottom) & ((kind != "top") | (rank < dressRank))
+    return clothes[accepted.to_numpy()]
+
+
+def scoreOutfits(outfitItems, photos):
+    """Scores every outfit two ways:
+
+    score1 is the average confidence of the closet items matched to the pic.
+
+    score2 sums the confidences above 0.3, but counts shoes only once, at
+    half weight, because shoes match most pics twice (people have two feet).
+
+    Args:
+        outfitItems (pd.DataFrame): From buildOutfits()
+        photos (list): Every photo to score. Photos without an outfit score 0.
+
+    Returns:
+        pd.DataFrame : score1 and score2, indexed by photo
+    """
+    photo = outfitItems["photo"]
+    score = outfitItems["score"]
+    isShoe = typeGroup(outfitItems["productLabel"]) == SHOE_GROUP
+    score1 = score.groupby(photo, observed=False).mean()
+    noShoeSum = score.where((score > 0.3) & ~isShoe, 0).groupby(photo, observed=False).sum()
+    shoeScore = score.where(isShoe).groupby(photo, observed=False).max()
+    scores = pd.DataFrame({"score1": score1,
+                           "score2": noShoeSum + shoeScore.fillna(0) * 0.5})
+    return scores.reindex(photos).fillna(0.0)
+
+
+def getOutfits(responses):
+    """Builds and scores an outfit for every inspiration pic.
+
+    Args:
+        responses (dict): {photo uri: productSet.search() response}
+
+    Returns:
+        tuple : (outfitItems, scores). outfitItems has a row per closet item in each
+            outfit (see matchTable for its columns), and scores has score1 and score2
+            indexed by photo.
+    """
+    outfitItems = buildOutfits(bestMatches(matchTable(responses)))
+    return outfitItems, scoreOutfits(outfitItems, list(responses))
+
+
+def sourceId(srcUri):
+    """Makes the id an inspiration pic's outfit is stored under in Firestore."""
+    return srcUri[len("gs://"):].replace("/", "-")
+
+
+def outfitDocument(srcUri, srcUrl, outfitItems, score1, score2, closetBucket):
+    """Makes the json document Firestore stores for a pic's outfit.
+
+    Args:
+        srcUri (String): The inspiration pic's uri
+        srcUrl (String): Its public url
+        outfitItems (pd.DataFrame): The rows of getOutfits()'s outfitItems for this pic
+        score1 (float): Its score1
+        score2 (float): Its score2
+        closetBucket (String): Bucket the closet's reference images are in
+
+    Returns:
+        dict : {"srcUrl", "srcUri", "score1", "score2", "matches": [{"score", "image",
+            "imageUrl", "label"}]}
+    """
+    matches = []
+    for match in outfitItems.itertuples():
+        imgName = match.image.split('/')[-1]
+        matches.append({
+            "score": float(match.score),
+            "image": match.image,
+            # The storage api makes these images publicly accessible through url
+            "imageUrl": f"https://storage.googleapis.com/{closetBucket}/" + imgName,
+            "label": match.productLabel,
+        })
+    return {
+        "srcUrl": srcUrl,
+        "srcUri": srcUri,
+        "score1": float(score1),
+        "score2": float(score2),
+        "matches": matches,
+    }
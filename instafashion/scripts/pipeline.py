@@ -0,0 +1,293 @@
+#  * Copyright 2020 Google LLC
+#  *
+#  * Licensed under the Apache License, Version 2.0 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  *      http://www.apache.org/licenses/LICENSE-2.0
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""Does everything getMatches.ipynb does, for only the inspiration pics
+that haven't been done before, so it can run every night:
+
+    python pipeline.py
+
+Pics stream through three stages, each with its own worker threads and
+connected by bounded queues, so all of them are busy at once: the bucket
+listing is paged through and pics are checked for fashion with the Vision
+API 16 at a time, fashion pics are searched for in the closet and made into
+outfits, and outfits are written to Firestore in batches. Every pic that's
+been checked (and, if it's a fashion pic, written) is recorded in a
+checkpoint file, and skipped the next time.
+
+Set LOCAL_INSPO_DIR in .env to read pics from folders on disk instead of
+Cloud Storage (see local_storage.py).
+"""
+
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from utils import batchAnnotateImages, clothingBoxes, MAX_BATCH_SIZE
+from outfits import getOutfits, outfitDocument, sourceId
+from firestore_writer import BatchWriter
+from local_storage import LocalBlob
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg")
+
+
+class Checkpoint:
+    """The pics that have been completely processed, kept as lines of
+    "uri#generation" in a text file that's appended to as pics finish, so
+    it survives crashes. A pic that's replaced in the bucket gets a new
+    generation, and is processed again. Pics skipped for not looking like
+    the closet are kept as "uri#generation#closetVersion", so they're
+    processed again once the closet changes. Safe to use from multiple
+    threads.
+
+    Args:
+        path (String): Text file to keep the checkpoint in
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done = {line.strip() for line in f if line.strip()}
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.done
+
+    def add(self, keys):
+        with self.lock:
+            keys = [key for key in keys if key not in self.done]
+            if not keys:
+                return
+            with open(self.path, "a") as f:
+                f.writelines(key + "\n" for key in keys)
+            self.done.update(keys)
+
+
+class Photo:
+    """An inspiration pic, and how to send it to the Vision API."""
+
+    def __init__(self, blob):
+        self.blob = blob
+        self.uri = f"gs://{blob.bucket.name}/{blob.name}"
+        self.url = blob.public_url
+        self.key = f"{self.uri}#{blob.generation}"
+        # Pics from a local stand-in bucket have to be sent by content
+        self.imageArgs = {"file_path": blob.path} if isinstance(blob, LocalBlob) \
+            else {"image_uri": self.uri}
+
+
+def isFashion(annotation):
+    return any([x.description == "Fashion" for x in annotation.label_annotations])
+
+
+def _runWorkers(workers, inQueue, fn, name):
+    # Starts threads that call fn on everything put in inQueue, until they
+    # each get a None
+    def _work():
+        while True:
+            item = inQueue.get()
+            if item is None:
+                return
+            try:
+                fn(item)
+            except Exception as error:
+                # A worker that died would leave nothing taking from
+                # inQueue, and whatever puts to it would block forever
+                print(f"Unexpected error in {threading.current_thread().name}: {error}")
+    threads = [threading.Thread(target=_work, name=f"{name}{i}", daemon=True)
+               for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def runPipeline(storageClient, inspoBucket, productSet, db, collection, closetBucket,
+                prefix=None, checkpointPath="processed.txt", visionCache=None,
+                closetIndex=None, minSimilarity=0.5, filterWorkers=4, matchWorkers=8,
+                queueSize=64, pageSize=1000):
+    """Finds, matches and stores outfits for every new pic in a bucket.
+
+    Args:
+        storageClient (storage.Client or LocalStorageClient): Where the pics are
+        inspoBucket (String): Bucket of inspiration pics
+        productSet (ProductSet): Closet product set to search
+        db (firestore.Client): Where to write outfits
+        collection (CollectionReference): Firestore collection to write them to
+        closetBucket (String): Bucket the closet's reference images are in
+        prefix (String, optional): Only process pics whose names start with this
+        checkpointPath (String, optional): File recording processed pics.
+            Defaults to "processed.txt".
+        visionCache (VisionCache, optional): Cache of Vision API responses
+        closetIndex (ClosetIndex, optional): If given, only pics that look like
+            something in the closet are searched for (see closet_index.py)
+        minSimilarity (float, optional): How alike a pic must be to the closet to be
+            searched for, if there's a closetIndex. Defaults to 0.5.
+        filterWorkers (int, optional): Concurrent Vision API requests. Defaults to 4.
+        matchWorkers (int, optional): Concurrent Product Search requests. Defaults to 8.
+        queueSize (int, optional): Most pics waiting between stages. Defaults to 64.
+        pageSize (int, optional): Pics per page of the bucket listing. Defaults to 1000.
+
+    Returns:
+        dict : How many pics were "listed", "skipped" (done in an earlier run),
+            "notFashion", "notLikeCloset", "written" and "failed"
+    """
+    checkpoint = Checkpoint(checkpointPath)
+    stats = Counter()
+    statsLock = threading.Lock()
+    # srcId -> checkpoint key of the pics whose outfits are being written
+    writing = {}
+
+    def _count(name, n=1):
+        with statsLock:
+            stats[name] += n
+
+    def _committed(docIds):
+        with statsLock:
+            keys = [writing.pop(docId, None) for docId in docIds]
+            keys = [key for key in keys if key]
+            stats["written"] += len(keys)
+        checkpoint.add(keys)
+
+    writer = BatchWriter(db, collection, onCommit=_committed)
+    chunks = queue.Queue(maxsize=max(1, queueSize // MAX_BATCH_SIZE))
+    photos = queue.Queue(maxsize=queueSize)
+
+    def _likeCloset(photo, annotation):
+        boxes, labels = clothingBoxes(annotation.localized_object_annotations)
+        # Pics with no clothes in them can't match anything
+        return len(boxes) > 0 and closetIndex.photoSimilarity(
+            photo.blob.download_as_string(), boxes, labels) >= minSimilarity
+
+    # 1. Check pics for fashion, 16 per Vision API request
+    def _filter(chunk):
+        try:
+            annotations = batchAnnotateImages(
+                file_paths=[p.imageArgs["file_path"] for p in chunk if "file_path" in p.imageArgs],
+                image_uris=[p.uri for p in chunk if "image_uri" in p.imageArgs],
+                cache=visionCache, generations={p.uri: p.blob.generation for p in chunk})
+        except Exception as error:
+            print(f"Couldn't annotate {len(chunk)} pics: {error}")
+            _count("failed", len(chunk))
+            return
+        skip = []
+        for photo in chunk:
+            try:
+                annotation = annotations[next(iter(photo.imageArgs.values()))]
+                if annotation.error.message:
+                    print(f"Couldn't annotate {photo.uri}: {annotation.error.message}")
+                    _count("failed")
+                elif not isFashion(annotation):
+                    _count("notFashion")
+                    skip.append(photo.key)
+                elif closetIndex and not _likeCloset(photo, annotation):
+                    _count("notLikeCloset")
+                    # Only skipped until the closet changes
+                    skip.append(f"{photo.key}#{closetIndex.version}")
+                else:
+                    photos.put(photo)
+            except Exception as error:
+                # Not checkpointed, so it's retried next run
+                print(f"Couldn't check {photo.uri}: {error}")
+                _count("failed")
+        # Pics with nothing to write are done as soon as they're checked
+        checkpoint.add(skip)
+
+    # 2. Search the closet for what's in each fashion pic, and make an outfit
+    def _match(photo):
+        try:
+            response = productSet.search("apparel", **photo.imageArgs)
+            outfitItems, scores = getOutfits({photo.uri: response})
+            document = outfitDocument(photo.uri, photo.url, outfitItems,
+                                      scores.loc[photo.uri, "score1"],
+                                      scores.loc[photo.uri, "score2"], closetBucket)
+        except Exception as error:
+            print(f"Couldn't match {photo.uri}: {error}")
+            _count("failed")
+            return
+        # 3. Write it to Firestore, in batches
+        srcId = sourceId(photo.uri)
+        with statsLock:
+            writing[srcId] = photo.key
+        writer.set(srcId, document)
+
+    start = time.time()
+    filterThreads = _runWorkers(filterWorkers, chunks, _filter, "filter")
+    matchThreads = _runWorkers(matchWorkers, photos, _match, "match")
+    try:
+        chunk = []
+        for blob in storageClient.list_blobs(inspoBucket, prefix=prefix, page_size=pageSize):
+            if not blob.name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            _count("listed")
+            photo = Photo(blob)
+            if photo.key in checkpoint or \
+                    (closetIndex and f"{photo.key}#{closetIndex.version}" in checkpoint):
+                _count("skipped")
+                continue
+            chunk.append(photo)
+            if len(chunk) == MAX_BATCH_SIZE:
+                chunks.put(chunk)
+                chunk = []
+        if chunk:
+            chunks.put(chunk)
+    finally:
+        # Let each stage finish what it has, then stop it
+        for _ in filterThreads:
+            chunks.put(None)
+        for thread in filterThreads:
+            thread.join()
+        for _ in matchThreads:
+            photos.put(None)
+        for thread in matchThreads:
+            thread.join()
+        try:
+            writer.close()
+        except Exception as error:
+            # Their pics aren't checkpointed, so they're retried next run
+            print(error)
+            _count("failed", sum(len(docIds) for docIds, _ in writer.errors))
+
+    stats["secs"] = round(time.time() - start, 2)
+    return dict(stats)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from google.cloud import firestore, storage
+    from pyvisionproductsearch import ProductSearch
+    from utils import VisionCache
+    from closet_index import ClosetIndex
+    from local_storage import LocalStorageClient
+    load_dotenv()
+
+    ps = ProductSearch(os.getenv("PROJECTID"), os.getenv("CREDS"), os.getenv("BUCKET"))
+    productSet = ps.getProductSet(os.getenv("PRODUCT_SET"))
+    storageClient = LocalStorageClient(os.getenv("LOCAL_INSPO_DIR")) \
+        if os.getenv("LOCAL_INSPO_DIR") else storage.Client()
+    db = firestore.Client()
+    # The same collection getMatches.ipynb writes to, so the app sees both
+    collection = db.collection(u'users').document(os.getenv("USER_ID")).collection(
+        os.getenv("OUTFITS_COLLECTION", u'outfitsDEMO'))
+    indexPath = os.getenv("CLOSET_INDEX", "closet_index.npz")
+
+    stats = runPipeline(storageClient, os.getenv("INSPO_BUCKET"), productSet, db, collection,
+                        os.getenv("BUCKET"), prefix=os.getenv("INSPO_SUBFOLDER"),
+                        checkpointPath=os.getenv("CHECKPOINT", "processed.txt"),
+                        visionCache=VisionCache(),
+                        closetIndex=ClosetIndex.load(indexPath) if os.path.exists(indexPath)
+                        else None)
+    print(stats)
@@ -12,51 +12,195 @@
 #  * See the License for the specific language governing permissions and
 #  * limitations under the License.
 
- 
+
 
 from pyvisionproductsearch import ProductSearch, ProductCategories
+from google.api_core import exceptions
+from closet_index import ClosetIndex
+import hashlib
+import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from collections import Counter
 
 load_dotenv()
 
-ps = ProductSearch(os.getenv("PROJECTID"),
-                   os.getenv("CREDS"), os.getenv("BUCKET"))
-
 
 def getLabel(fileName):
     # The label is just the last word in the filename
     return fileName.split("_")[-1].lower()
 
 
-try:
-    productSet = ps.getProductSet(os.getenv("PRODUCT_SET"))
-except:
-    productSet = ps.createProductSet(os.getenv("PRODUCT_SET"))
-
-labels = []
-for folder in os.listdir(os.getenv("CLOSET_DIR")):
-
-    label = getLabel(folder)
-    labels.append(label)
-
-    print(f"Creating product {folder}")
-
-    product = ps.createProduct(
-        folder, "apparel", labels={"type": label})
-
-    imgFolder = os.path.join(os.getenv("CLOSET_DIR"), folder)
-
-    for img in os.listdir(imgFolder):
+def fileHash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class ImportManifest:
+    """Records which products and reference images have been created, saved
+    to a json file after every change so an import that crashed or was
+    stopped can be rerun without creating duplicates. Images are recorded
+    with a hash of their content, so one that's been edited since gets
+    uploaded again. Safe to use from multiple threads.
+
+    Args:
+        path (String): json file to keep the manifest in
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.products = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.products = json.load(f)["products"]
+
+    def product(self, productId):
+        with self.lock:
+            return dict(self.products.get(productId, {}))
+
+    def uploadedHashes(self, productId):
+        """Returns the content hashes of every image uploaded to a product."""
+        with self.lock:
+            images = self.products.get(productId, {}).get("images", {}).values()
+            return {image["sha256"] for image in images if image.get("status") == "done"}
+
+    def updateProduct(self, productId, **fields):
+        with self.lock:
+            self.products.setdefault(productId, {"images": {}}).update(fields)
+            self._save()
+
+    def updateImage(self, productId, imageName, **fields):
+        with self.lock:
+            images = self.products.setdefault(productId, {"images": {}})["images"]
+            images.setdefault(imageName, {}).update(fields)
+            self._save()
+
+    def _save(self):
+        with open(self.path + ".part", "w") as f:
+            json.dump({"products": self.products}, f, indent=2)
+        os.replace(self.path + ".part", self.path)
+
+
+def getOrCreateProduct(ps, manifest, productId, label):
+    if manifest.product(productId).get("created"):
+        return ps.getProduct(productId)
+    try:
+        product = ps.createProduct(productId, "apparel", labels={"type": label})
+        print(f"Created product {productId}")
+    except exceptions.AlreadyExists:
+        # Made by a run from before there was a manifest
+        product = ps.getProduct(productId)
+    manifest.updateProduct(productId, created=True, label=label)
+    return product
+
+
+def importCloset(ps, productSet, closetDir, manifest, workers=8):
+    """Creates a product for every folder in closetDir, uploads the pictures
+    in it as the product's reference images, and adds it to productSet.
+    Anything the manifest says was already done is skipped.
+
+    Returns:
+        dict : Counts of "uploaded", "skipped" and "failed" images, "bytes" uploaded,
+            "failures" as [(path, error)] and "labels" as a Counter
+    """
+    stats = Counter()
+    failures = []
+    labels = Counter()
+    lock = threading.Lock()
+
+    def _upload(product, productId, imgPath, sha256):
+        imgName = os.path.basename(imgPath)
         try:
-            product.addReferenceImage(os.path.join(imgFolder, img))
-        except:
-            print(f"Couldn't add reference image {imgFolder}/{img}")
-
-    productSet.addProduct(product)
-    print(f"Added product {product.displayName} to set")
-
-numAdded = len(productSet.listProducts())
-print(f"Added {numAdded} products to set")
-print(Counter(labels))
+            product.addReferenceImage(imgPath)
+        except Exception as error:
+            manifest.updateImage(productId, imgName, sha256=sha256, status="failed",
+                                 error=str(error))
+            with lock:
+                stats["failed"] += 1
+                failures.append((imgPath, str(error)))
+            print(f"Couldn't add reference image {imgPath}: {error}")
+            return
+        manifest.updateImage(productId, imgName, sha256=sha256, status="done", error=None)
+        with lock:
+            stats["uploaded"] += 1
+            stats["bytes"] += os.path.getsize(imgPath)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        jobs = []
+        for folder in sorted(os.listdir(closetDir)):
+            imgFolder = os.path.join(closetDir, folder)
+            if not os.path.isdir(imgFolder):
+                continue
+            label = getLabel(folder)
+            labels[label] += 1
+
+            try:
+                product = getOrCreateProduct(ps, manifest, folder, label)
+                if not manifest.product(folder).get("inSet"):
+                    productSet.addProduct(product)
+                    manifest.updateProduct(folder, inSet=True)
+                    print(f"Added product {product.displayName} to set")
+            except Exception as error:
+                print(f"Couldn't create product {folder}: {error}")
+                with lock:
+                    stats["failed"] += 1
+                    failures.append((imgFolder, str(error)))
+                continue
+
+            # Pictures are matched by content, so one that was renamed isn't
+            # uploaded again, and the same picture saved twice is uploaded once
+            seen = manifest.uploadedHashes(folder)
+            for img in sorted(os.listdir(imgFolder)):
+                imgPath = os.path.join(imgFolder, img)
+                sha256 = fileHash(imgPath)
+                if sha256 in seen:
+                    stats["skipped"] += 1
+                    continue
+                seen.add(sha256)
+                jobs.append(pool.submit(_upload, product, folder, imgPath, sha256))
+
+        for job in jobs:
+            job.result()
+
+    stats["failures"] = failures
+    stats["labels"] = labels
+    return stats
+
+
+if __name__ == "__main__":
+    ps = ProductSearch(os.getenv("PROJECTID"),
+                       os.getenv("CREDS"), os.getenv("BUCKET"))
+
+    try:
+        productSet = ps.getProductSet(os.getenv("PRODUCT_SET"))
+    except exceptions.NotFound:
+        productSet = ps.createProductSet(os.getenv("PRODUCT_SET"))
+
+    manifest = ImportManifest(os.getenv("IMPORT_MANIFEST", "closet_import.json"))
+    start = time.time()
+    stats = importCloset(ps, productSet, os.getenv("CLOSET_DIR"), manifest,
+                         workers=int(os.getenv("IMPORT_WORKERS", 8)))
+    secs = time.time() - start
+
+    print(f"Uploaded {stats['uploaded']} images ({stats['bytes'] / 1024 ** 2:.1f} MB) "
+          f"in {secs:.1f}s: {stats['uploaded'] / secs:.1f} images/s, "
+          f"{stats['bytes'] / 1024 ** 2 / secs:.2f} MB/s")
+    print(f"Skipped {stats['skipped']} images that were already uploaded")
+    if stats["failures"]:
+        print(f"{len(stats['failures'])} failed, rerun to retry them:")
+        for path, error in stats["failures"]:
+            print(f"  {path}: {error}")
+
+    numAdded = len(productSet.listProducts())
+    print(f"Added {numAdded} products to set")
+    print(stats["labels"])
+
+    # A local index of the closet, for getMatches.ipynb to skip searching
+    # for inspiration pics that don't look like anything in it
+    closetIndex = ClosetIndex.build(os.getenv("CLOSET_DIR"), getLabel)
+    closetIndex.save(os.getenv("CLOSET_INDEX", "closet_index.npz"))
+    print(f"Indexed {len(closetIndex.hashes)} images of {len(closetIndex.products)} products")
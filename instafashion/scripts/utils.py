@@ -16,8 +16,18 @@
 from google.cloud import vision
 from google.cloud.vision import types
 from pyvisionproductsearch import ProductSearch, ProductCategories
+import hashlib
 import io
 import os
+import sqlite3
+import threading
+import time
+
+# The most images the Vision API will annotate in one batch_annotate_images call
+MAX_BATCH_SIZE = 16
+
+DEFAULT_FEATURES = [vision.enums.Feature.Type.LABEL_DETECTION,
+                    vision.enums.Feature.Type.OBJECT_LOCALIZATION]
 
 CLOTHING_OBJECT_LABELS = [
    "Outerwear",
@@ -68,43 +78,254 @@ CLOTHING_OBJECT_LABELS = [
 ]
 
 
-def detectLabels(file_path=None, image_uri=None):
+_client = None
+_clientLock = threading.Lock()
+
+
+def getClient():
+    """Returns one ImageAnnotatorClient, created the first time it's needed and
+    then shared by every function in this file. Clients are thread-safe, and
+    reusing one saves setting up a new connection for every image."""
+    global _client
+    with _clientLock:
+        if not _client:
+            _client = vision.ImageAnnotatorClient()
+        return _client
+
+
+def _loadImage(file_path=None, image_uri=None):
+    if file_path:
+        with io.open(file_path, 'rb') as image_file:
+            return vision.types.Image(content=image_file.read())
+    image_source = vision.types.ImageSource(image_uri=image_uri)
+    return vision.types.Image(source=image_source)
+
+
+def detectLabels(file_path=None, image_uri=None, client=None, cache=None):
 
     if bool(file_path) == bool(image_uri):
         raise Exception(
             "Must provide one of either a file path or an image uri")
-    
-    client = vision.ImageAnnotatorClient()
 
-    if file_path:
-        with io.open(file_path, 'rb') as image_file:
-            content = image_file.read()
-            image = vision.types.Image(content=content)
-    else:
-        image_source = vision.types.ImageSource(image_uri=image_uri)
-        image = vision.types.Image(source=image_source)
+    if cache:
+        return _annotateOne(file_path, image_uri, vision.enums.Feature.Type.LABEL_DETECTION,
+                            client, cache).label_annotations
+
+    client = client if client else getClient()
+    image = _loadImage(file_path, image_uri)
 
     # Performs label detection on the image file
     response = client.label_detection(image=image)
     return response.label_annotations
 
 
-def detectObjects(file_path=None, image_uri=None):
+def detectObjects(file_path=None, image_uri=None, client=None, cache=None):
 
     if bool(file_path) == bool(image_uri):
         raise Exception(
             "Must provide one of either a file path or an image uri")
-    
-    client = vision.ImageAnnotatorClient()
 
-    if file_path:
-        with io.open(file_path, 'rb') as image_file:
-            content = image_file.read()
-            image = vision.types.Image(content=content)
-    else:
-        image_source = vision.types.ImageSource(image_uri=image_uri)
-        image = vision.types.Image(source=image_source)
+    if cache:
+        return _annotateOne(file_path, image_uri, vision.enums.Feature.Type.OBJECT_LOCALIZATION,
+                            client, cache).localized_object_annotations
+
+    client = client if client else getClient()
+    image = _loadImage(file_path, image_uri)
 
     # Performs label detection on the image file
     return client.object_localization(
         image=image).localized_object_annotations
+
+
+def _annotateOne(file_path, image_uri, feature, client, cache):
+    results = batchAnnotateImages(file_paths=[file_path] if file_path else [],
+                                  image_uris=[image_uri] if image_uri else [],
+                                  features=[feature], client=client, cache=cache)
+    response = results[file_path or image_uri]
+    if response.error.message:
+        raise Exception(response.error.message)
+    return response
+
+
+class VisionCache:
+    """Saves Vision API responses in a SQLite file, so annotating the same
+    image again, i.e. when the notebook is rerun on a bucket that only gained
+    a few new photos, doesn't cost another request.
+
+    Local images are looked up by a hash of their content, and images in
+    Cloud Storage by their uri and generation (which changes whenever the
+    object is overwritten), so a changed image is never served stale results.
+    Images given by uri alone are looked up by uri, and only expire with ttl.
+
+    Args:
+        path (String, optional): SQLite file to keep responses in.
+            Defaults to "vision_cache.sqlite".
+        ttl (float, optional): Seconds a response stays valid. Defaults to None,
+            which keeps responses forever.
+        maxMb (float, optional): Size limit. Once it's reached, the least recently
+            used responses are dropped. Defaults to 256.
+    """
+
+    def __init__(self, path="vision_cache.sqlite", ttl=None, maxMb=256):
+        self.ttl = ttl
+        self.maxBytes = maxMb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY, response BLOB, size INTEGER, created REAL, used REAL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+        self.db.commit()
+        self.size = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def key(features, file_path=None, image_uri=None, generation=None):
+        """Makes the cache key of an image annotated with features."""
+        if file_path:
+            with io.open(file_path, 'rb') as image_file:
+                image = "sha256:" + hashlib.sha256(image_file.read()).hexdigest()
+        else:
+            image = f"{image_uri}#{generation}" if generation else image_uri
+        return ",".join(str(int(feature)) for feature in sorted(features)) + "|" + image
+
+    def get(self, key):
+        """Returns the cached AnnotateImageResponse for key, or None."""
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT response, size, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and self.ttl and now - row[2] > self.ttl:
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.db.commit()
+                self.size -= row[1]
+                row = None
+            if not row:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute("UPDATE responses SET used = ? WHERE key = ?", (now, key))
+            self.db.commit()
+        return vision.types.AnnotateImageResponse.FromString(row[0])
+
+    def put(self, key, response):
+        """Caches response under key, making room for it if needed."""
+        data = response.SerializeToString()
+        now = time.time()
+        with self.lock:
+            old = self.db.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                            (key, data, len(data), now, now))
+            self.size += len(data) - (old[0] if old else 0)
+            while self.size > self.maxBytes:
+                oldest = self.db.execute(
+                    "SELECT key, size FROM responses ORDER BY used LIMIT 64").fetchall()
+                if not oldest:
+                    break
+                for oldKey, size in oldest:
+                    self.db.execute("DELETE FROM responses WHERE key = ?", (oldKey,))
+                    self.size -= size
+                    if self.size <= self.maxBytes:
+                        break
+            self.db.commit()
+
+    def stats(self):
+        """Returns how well the cache has done since it was opened."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+                "entries": self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0],
+                "mb": self.size / 1024 / 1024,
+            }
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def batchAnnotateImages(file_paths=[], image_uris=[], features=DEFAULT_FEATURES,
+                        batch_size=MAX_BATCH_SIZE, client=None, cache=None, generations={}):
+    """Runs several kinds of detection on many images, sending up to
+    batch_size images and all of the features in each request, instead of one
+    request per image per feature like detectLabels and detectObjects.
+
+    Args:
+        file_paths (list, optional): Local images to annotate
+        image_uris (list, optional): Images in Cloud Storage (gs://...) or on the web
+        features (list, optional): vision.enums.Feature.Type values to detect.
+            Defaults to labels and objects.
+        batch_size (int, optional): Images per request, at most 16. Defaults to 16.
+        client (vision.ImageAnnotatorClient, optional): Defaults to getClient().
+        cache (VisionCache, optional): Where to look for responses from earlier runs,
+            and save new ones. Defaults to None, which doesn't cache.
+        generations (dict, optional): {uri: generation} of Cloud Storage images, i.e.
+            from blob.generation, so the cache notices when an image is replaced.
+
+    Returns:
+        dict : {file path or uri: AnnotateImageResponse}. Read label_annotations and
+            localized_object_annotations from each response; an image that couldn't be
+            annotated has its reason in response.error.message instead.
+    """
+    if not 0 < batch_size <= MAX_BATCH_SIZE:
+        raise Exception(f"batch_size must be between 1 and {MAX_BATCH_SIZE}")
+
+    client = client if client else getClient()
+    featureList = [vision.types.Feature(type=feature) for feature in features]
+    # Each image is annotated once, even if it's listed twice
+    inputs = list(dict.fromkeys([("file_path", x) for x in file_paths] +
+                                [("image_uri", x) for x in image_uris]))
+
+    results = {}
+    keys = {}
+    if cache:
+        todo = []
+        for kind, value in inputs:
+            keys[value] = cache.key(features, generation=generations.get(value),
+                                    **{kind: value})
+            cached = cache.get(keys[value])
+            if cached:
+                results[value] = cached
+            else:
+                todo.append((kind, value))
+        inputs = todo
+
+    for i in range(0, len(inputs), batch_size):
+        chunk = inputs[i:i + batch_size]
+        # Local images are only read when their batch is sent, so a big
+        # directory is never in memory all at once
+        requests = [vision.types.AnnotateImageRequest(
+            image=_loadImage(**{kind: value}), features=featureList)
+            for kind, value in chunk]
+        response = client.batch_annotate_images(requests)
+        for (_, value), result in zip(chunk, response.responses):
+            results[value] = result
+            # Failures might be temporary, so only successes are cached
+            if cache and not result.error.message:
+                cache.put(keys[value], result)
+    return results
+
+
+def clothingBoxes(objects):
+    """Picks out the clothes among the objects the Vision API found in an image.
+
+    Args:
+        objects (list): localized_object_annotations of an AnnotateImageResponse
+
+    Returns:
+        tuple : (boxes, labels). Each box is (left, top, right, bottom) as fractions of
+            the image's size, and each label the object's name, i.e. "Shorts".
+    """
+    boxes, labels = [], []
+    for obj in objects:
+        if obj.name not in CLOTHING_OBJECT_LABELS:
+            continue
+        xs = [vertex.x for vertex in obj.bounding_poly.normalized_vertices]
+        ys = [vertex.y for vertex in obj.bounding_poly.normalized_vertices]
+        boxes.append((min(xs), min(ys), max(xs), max(ys)))
+        labels.append(obj.name)
+    return boxes, labels
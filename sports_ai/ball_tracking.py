@@ -0,0 +1,300 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Finds the ball in every frame of a video with an AutoML Vision object
+detection model, without writing the frames to disk:
+
+    predictor = AutoMLPredictor(project_id, model_id)
+    for frame, balls in detectBalls(readFrames("serve.mp4", fps=20), predictor):
+        ...
+
+ffmpeg decodes the video into a pipe, and each frame is only turned into
+a jpeg to send it to the model. Several frames are sent at once, all on
+one client, and frames that look exactly like one seen before (i.e. when
+the camera and players are still) aren't sent again.
+
+Anything that takes jpeg bytes and returns a list of boxes can stand in
+for the model, which is handy for trying this out without one:
+
+    python ball_tracking.py serve.mp4
+"""
+
+import hashlib
+import io
+import json
+import os
+import subprocess
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+
+class Frame:
+    """A decoded video frame.
+
+    Attributes:
+        index (int): Frame number, counting from 0
+        timestamp (float): Seconds into the video
+        pixels (np.array): RGB pixels, shape (height, width, 3)
+    """
+
+    def __init__(self, index, timestamp, pixels):
+        self.index = index
+        self.timestamp = timestamp
+        self.pixels = pixels
+
+    def key(self):
+        """Hash of the frame's pixels."""
+        return hashlib.sha256(self.pixels.tobytes()).hexdigest()
+
+    def image(self):
+        return Image.fromarray(self.pixels)
+
+    def jpeg(self, quality=90):
+        buffer = io.BytesIO()
+        self.image().save(buffer, format="JPEG", quality=quality)
+        return buffer.getvalue()
+
+
+def videoSize(path, ffprobe="ffprobe"):
+    """The (width, height) of a video's frames as ffmpeg outputs them, i.e.
+    swapped if the video is rotated (as phone videos often are)."""
+    output = subprocess.run(
+        [ffprobe, "-v", "error", "-select_streams", "v:0", "-show_entries",
+         "stream=width,height:stream_tags=rotate:stream_side_data=rotation",
+         "-of", "json", path], capture_output=True, check=True, text=True).stdout
+    stream = json.loads(output)["streams"][0]
+    rotation = int(stream.get("tags", {}).get("rotate", 0))
+    for sideData in stream.get("side_data_list", []):
+        rotation = int(sideData.get("rotation", rotation))
+    width, height = stream["width"], stream["height"]
+    return (height, width) if rotation % 180 else (width, height)
+
+
+def readFrames(path, fps=20, start=None, duration=None, ffmpeg="ffmpeg", ffprobe="ffprobe"):
+    """Decodes a video with ffmpeg, one frame at a time.
+
+    Args:
+        path (String): The video file
+        fps (int, optional): Frames per second to take from the video. Defaults to 20.
+        start (float, optional): Seconds into the video to start at
+        duration (float, optional): Seconds of video to read. Defaults to all of it.
+        ffmpeg (String, optional): The ffmpeg command. Defaults to "ffmpeg".
+        ffprobe (String, optional): The ffprobe command. Defaults to "ffprobe".
+
+    Yields:
+        Frame : Every frame, in order
+    """
+    width, height = videoSize(path, ffprobe)
+    frameSize = width * height * 3
+    command = [ffmpeg, "-v", "error"]
+    if start:
+        command += ["-ss", str(start)]
+    command += ["-i", path]
+    if duration:
+        command += ["-t", str(duration)]
+    command += ["-vf", f"fps={fps}", "-f", "rawvideo", "-pix_fmt", "rgb24", "pipe:"]
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               bufsize=frameSize)
+    # Read errors as they come, so ffmpeg never blocks on a full stderr pipe
+    errors = []
+    errorReader = threading.Thread(target=lambda: errors.append(process.stderr.read()),
+                                   daemon=True)
+    errorReader.start()
+    try:
+        index = 0
+        while True:
+            data = process.stdout.read(frameSize)
+            if len(data) < frameSize:
+                break
+            pixels = np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3)
+            yield Frame(index, (start or 0) + index / fps, pixels)
+            index += 1
+    finally:
+        # Stops ffmpeg if we're done before the video is
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        errorReader.join()
+    if process.returncode and process.returncode > 0:
+        raise Exception(f"ffmpeg failed: {errors[0].decode(errors='replace').strip()}")
+
+
+class AutoMLPredictor:
+    """Finds objects in images with an AutoML Vision object detection
+    model. Every prediction goes through one client, which is safe to use
+    from multiple threads.
+
+    Args:
+        projectId (String): Your GCP project id
+        modelId (String): The AutoML model id
+        scoreThreshold (float, optional): Least confidence of objects to return. This
+            changes the sensitivity of your model. Defaults to 0.7.
+        location (String, optional): Where the model is. Defaults to "us-central1".
+        client (automl.PredictionServiceClient, optional): Client to predict with
+    """
+
+    def __init__(self, projectId, modelId, scoreThreshold=0.7, location="us-central1",
+                 client=None):
+        from google.cloud import automl
+        self.automl = automl
+        self.client = client if client else automl.PredictionServiceClient()
+        self.name = f"projects/{projectId}/locations/{location}/models/{modelId}"
+        self.params = {"score_threshold": str(scoreThreshold)}
+
+    def __call__(self, jpeg):
+        """Returns the objects in a jpeg, as a list of (left, top, right, bottom,
+        score) tuples, with positions as fractions of the image's width and height
+        measured from the top left corner."""
+        image = self.automl.types.Image(image_bytes=jpeg)
+        payload = self.automl.types.ExamplePayload(image=image)
+        response = self.client.predict(self.name, payload, self.params)
+        boxes = []
+        for obj in response.payload:
+            detection = obj.image_object_detection
+            topLeft, bottomRight = detection.bounding_box.normalized_vertices
+            boxes.append((topLeft.x, topLeft.y, bottomRight.x, bottomRight.y, detection.score))
+        return boxes
+
+
+class PredictionCache:
+    """Predictions by frame hash (see Frame.key), so a frame that's been
+    seen before, in this video or an earlier run, isn't sent to the model
+    again. Safe to use from multiple threads.
+
+    Args:
+        path (String, optional): Json file to keep the cache in between runs. Only
+            kept in memory if not given.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.predictions = {}
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.predictions = {key: [tuple(box) for box in boxes]
+                                    for key, boxes in json.load(f).items()}
+
+    def get(self, key):
+        with self.lock:
+            boxes = self.predictions.get(key)
+            if boxes is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return boxes
+
+    def put(self, key, boxes):
+        with self.lock:
+            self.predictions[key] = boxes
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            predictions = dict(self.predictions)
+        with open(self.path + ".part", "w") as f:
+            json.dump(predictions, f)
+        os.replace(self.path + ".part", self.path)
+
+
+def detectBalls(frames, predictor, cache=None, workers=8, maxPending=None):
+    """Runs a model on every frame, several frames at a time.
+
+    Args:
+        frames (iterable): Frames to look at, i.e. from readFrames
+        predictor (function): Takes jpeg bytes and returns a list of boxes, i.e. an
+            AutoMLPredictor
+        cache (PredictionCache, optional): Where to look up and keep predictions.
+            Defaults to a new, in-memory one.
+        workers (int, optional): Predictions to make at once. Defaults to 8.
+        maxPending (int, optional): Most frames to hold in memory while waiting for
+            their predictions. Defaults to 4 times workers.
+
+    Yields:
+        tuple : (frame, boxes) for every frame, in order
+    """
+    cache = cache if cache else PredictionCache()
+    maxPending = maxPending if maxPending else workers * 4
+    # Frame hash -> future, so identical frames waiting at the same time
+    # share one prediction
+    predicting = {}
+
+    def _predict(key, frame):
+        boxes = cache.get(key)
+        if boxes is None:
+            boxes = predictor(frame.jpeg())
+            cache.put(key, boxes)
+        return boxes
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for frame in frames:
+            key = frame.key()
+            future = predicting.get(key)
+            if future is None:
+                future = predicting[key] = pool.submit(_predict, key, frame)
+            pending.append((frame, key, future))
+            if len(pending) >= maxPending:
+                yield _finish(pending, predicting)
+        while pending:
+            yield _finish(pending, predicting)
+
+
+def _finish(pending, predicting):
+    frame, key, future = pending.popleft()
+    boxes = future.result()
+    if predicting.get(key) is future and not any(f is future for _, _, f in pending):
+        del predicting[key]
+    return frame, boxes
+
+
+def drawBalls(frame, boxes, scale=0.2):
+    """Shrinks a frame and draws a rectangle around each box."""
+    from PIL import ImageDraw
+    im = frame.image()
+    im.thumbnail((im.width * scale, im.height * scale))
+    draw = ImageDraw.Draw(im)
+    for left, top, right, bottom, _ in boxes:
+        draw.rectangle([(left * im.width, top * im.height),
+                        (right * im.width, bottom * im.height)])
+    return im
+
+
+if __name__ == "__main__":
+    # Runs a video through a stand-in for the model, twice, to check the
+    # frames come out in order and the second run is all cache hits
+    import sys
+    import time
+
+    def fakePredictor(jpeg):
+        time.sleep(0.05)  # About as long as a real prediction takes
+        image = Image.open(io.BytesIO(jpeg))
+        return [(0.4, 0.4, 0.6, 0.6, image.width / (image.width + image.height))]
+
+    cache = PredictionCache()
+    for run in range(2):
+        start = time.time()
+        indices = [frame.index for frame, _ in detectBalls(readFrames(sys.argv[1]),
+                                                           fakePredictor, cache)]
+        assert indices == list(range(len(indices))), "Frames came out of order"
+        print(f"{len(indices)} frames in {time.time() - start:.2f}s, "
+              f"{cache.hits} cache hits, {cache.misses} misses")
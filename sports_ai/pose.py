@@ -0,0 +1,266 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Loads the pose landmarks from the Video Intelligence API's person
+detection output into NumPy arrays, and computes joint angles for every
+frame at once.
+
+The output json of a long video can be hundreds of MB, so rather than
+json.load it whole, loadPoses reads it a chunk at a time and only ever
+decodes one frame (a "timestamped object") at a time, writing its
+landmarks straight into arrays allocated up front.
+
+    poses = loadPoses("output.json")
+    angles = jointAngles(poses.points)
+    angles["right_elbow"]  # One angle per frame, in degrees
+"""
+
+import json
+import re
+import numpy as np
+import pandas as pd
+
+# Pose landmarks the Video Intelligence API tracks, in the order they're
+# stored in Poses.points
+LANDMARKS = ["nose", "left_eye", "right_eye", "left_ear", "right_ear",
+             "left_shoulder", "right_shoulder", "left_elbow", "right_elbow",
+             "left_wrist", "right_wrist", "left_hip", "right_hip",
+             "left_knee", "right_knee", "left_ankle", "right_ankle"]
+LANDMARK_INDEX = {name: i for i, name in enumerate(LANDMARKS)}
+
+# Joint -> the three landmarks whose angle it is, the joint in the middle
+JOINTS = {
+    "elbow": ("wrist", "elbow", "shoulder"),
+    "shoulder": ("hip", "shoulder", "elbow"),
+    "knee": ("ankle", "knee", "hip"),
+}
+
+CHUNK_SIZE = 1024 * 1024
+
+# The start of a person's list of tracks, or of a track's list of frames
+_ARRAY_START = re.compile(r'"(tracks|timestamped_objects)"\s*:\s*\[')
+_SEPARATORS = re.compile(r'[\s,]*')
+
+
+class Poses:
+    """Every frame of every person in a video.
+
+    Attributes:
+        timestamps (np.array): Time of each frame in seconds, shape (frames,)
+        people (np.array): Which person (in the order of the API's output) each frame
+            is of, shape (frames,)
+        tracks (np.array): Which track each frame belongs to, shape (frames,)
+        points (np.array): x and y of each landmark (see LANDMARKS) in each frame, as
+            fractions of the video's width and height, with y measured up from the bottom.
+            Landmarks that weren't detected are nan. Shape (frames, landmarks, 2).
+        confidence (np.array): Confidence of each landmark, shape (frames, landmarks)
+    """
+
+    def __init__(self, timestamps, people, tracks, points, confidence):
+        self.timestamps = timestamps
+        self.people = people
+        self.tracks = tracks
+        self.points = points
+        self.confidence = confidence
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def sortedByTime(self):
+        """Returns the same frames, ordered by timestamp."""
+        order = np.argsort(self.timestamps, kind="stable")
+        return Poses(self.timestamps[order], self.people[order], self.tracks[order],
+                     self.points[order], self.confidence[order])
+
+    def toDataFrame(self, angles=False):
+        """Puts the frames into a DataFrame, sorted by timestamp, with columns
+        timestamp, person, and <landmark>_x and <landmark>_y for every landmark
+        (i.e. right_wrist_y), plus <side>_<joint>_angle for every joint if angles
+        is True."""
+        poses = self.sortedByTime()
+        columns = {"timestamp": poses.timestamps, "person": poses.people}
+        for i, name in enumerate(LANDMARKS):
+            columns[f"{name}_x"] = poses.points[:, i, 0]
+            columns[f"{name}_y"] = poses.points[:, i, 1]
+        if angles:
+            for name, values in jointAngles(poses.points).items():
+                columns[f"{name}_angle"] = values
+        return pd.DataFrame(columns)
+
+
+def _seconds(timeOffset):
+    # Durations are either {"seconds": 1, "nanos": 500000000} or "1.5s"
+    if isinstance(timeOffset, str):
+        return float(timeOffset.rstrip("s"))
+    return timeOffset.get("minutes", 0) * 60 + timeOffset.get("seconds", 0) + \
+        timeOffset.get("nanos", 0) / 10**9
+
+
+def _countFrames(path, chunkSize):
+    # A quick pass to estimate the number of frames, so the arrays are
+    # usually only allocated once. Frames without a time_offset aren't
+    # counted, so loadPoses grows the arrays if it runs out of room.
+    key = '"time_offset"'
+    count = 0
+    tail = ""
+    with open(path, encoding="utf-8") as f:
+        while True:
+            chunk = f.read(chunkSize)
+            if not chunk:
+                return count
+            text = tail + chunk
+            count += text.count(key)
+            # Keep enough to find a key split across chunks, but not
+            # enough to count a whole one twice
+            tail = text[-(len(key) - 1):]
+
+
+def iterFrames(path, chunkSize=CHUNK_SIZE):
+    """Reads the frames out of a Video Intelligence output json file, a
+    chunk at a time.
+
+    Yields:
+        tuple : (person, track, timestampedObject) for every frame, where person and
+            track count up from 0 and timestampedObject is the frame's decoded json
+    """
+    decoder = json.JSONDecoder()
+    person = track = -1
+    inArray = False
+    buffer = ""
+    pos = 0
+    eof = False
+    with open(path, encoding="utf-8") as f:
+        def _readMore():
+            nonlocal buffer, pos, eof
+            chunk = f.read(chunkSize)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+        while True:
+            if not inArray:
+                match = _ARRAY_START.search(buffer, pos)
+                if not match:
+                    if eof:
+                        return
+                    # Keep the end, in case it's the start of a key
+                    pos = max(pos, len(buffer) - 256)
+                    _readMore()
+                    continue
+                pos = match.end()
+                if match.group(1) == "tracks":
+                    person += 1
+                else:
+                    track += 1
+                    inArray = True
+                continue
+
+            pos = _SEPARATORS.match(buffer, pos).end()
+            if pos == len(buffer):
+                if eof:
+                    raise ValueError(f"{path} ended in the middle of a track")
+                _readMore()
+                continue
+            if buffer[pos] == "]":
+                pos += 1
+                inArray = False
+                continue
+            try:
+                frame, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The frame goes on into the next chunk
+                if eof:
+                    raise
+                _readMore()
+                continue
+            pos = end
+            yield max(person, 0), track, frame
+
+
+def loadPoses(path, chunkSize=CHUNK_SIZE):
+    """Loads every person's pose landmarks from a Video Intelligence person
+    detection output json file.
+
+    Args:
+        path (String): The output json file
+        chunkSize (int, optional): Characters to read at a time. Defaults to 1M.
+
+    Returns:
+        Poses : Every frame, in the order they appear in the file
+    """
+    capacity = _countFrames(path, chunkSize)
+    timestamps = np.zeros(capacity, dtype=np.float64)
+    people = np.zeros(capacity, dtype=np.int32)
+    tracks = np.zeros(capacity, dtype=np.int32)
+    points = np.full((capacity, len(LANDMARKS), 2), np.nan, dtype=np.float32)
+    confidence = np.zeros((capacity, len(LANDMARKS)), dtype=np.float32)
+
+    def _grow(array, fill):
+        # Doubles the number of rows an array has room for
+        grown = np.full((max(2 * len(array), 1024),) + array.shape[1:], fill, dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    n = 0
+    for person, track, frame in iterFrames(path, chunkSize):
+        if n == len(timestamps):
+            timestamps, people, tracks = (_grow(x, 0) for x in (timestamps, people, tracks))
+            points, confidence = _grow(points, np.nan), _grow(confidence, 0)
+        timestamps[n] = _seconds(frame.get("time_offset", {}))
+        people[n] = person
+        tracks[n] = track
+        framePoints = points[n]
+        frameConfidence = confidence[n]
+        for landmark in frame.get("landmarks", []):
+            i = LANDMARK_INDEX.get(landmark["name"])
+            if i is None:
+                continue
+            point = landmark["point"]
+            framePoints[i, 0] = point.get("x", 0)
+            # Subtract y value from 1 because positions are calculated
+            # from the top left corner
+            framePoints[i, 1] = 1 - point.get("y", 0)
+            frameConfidence[i] = landmark.get("confidence", 0)
+        n += 1
+
+    return Poses(timestamps[:n], people[:n], tracks[:n], points[:n], confidence[:n])
+
+
+def angle(a, b, c):
+    """The angle abc in degrees, for arrays of points (..., 2), measured the
+    same way as the notebook's getAngle: the direction of bc minus the
+    direction of ba, between -360 and 360."""
+    return np.degrees(np.arctan2(c[..., 1] - b[..., 1], c[..., 0] - b[..., 0]) -
+                      np.arctan2(a[..., 1] - b[..., 1], a[..., 0] - b[..., 0]))
+
+
+def jointAngles(points, sides=("left", "right")):
+    """Computes the elbow, shoulder and knee angles of every frame.
+
+    Args:
+        points (np.array): Landmarks, shape (frames, landmarks, 2), i.e. Poses.points
+        sides (tuple, optional): Sides of the body to compute. Defaults to both.
+
+    Returns:
+        dict : {"<side>_<joint>": np.array of angles in degrees}, i.e. "right_elbow".
+            Frames missing any of a joint's landmarks have a nan angle.
+    """
+    angles = {}
+    for side in sides:
+        for joint, (a, b, c) in JOINTS.items():
+            angles[f"{side}_{joint}"] = angle(
+                points[:, LANDMARK_INDEX[f"{side}_{a}"]],
+                points[:, LANDMARK_INDEX[f"{side}_{b}"]],
+                points[:, LANDMARK_INDEX[f"{side}_{c}"]])
+    return angles